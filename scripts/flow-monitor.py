@@ -9,27 +9,85 @@ Tracks ALL active sessions through ns_vip:
 
 Writes to /run/pathsteer/flows.json
 """
+import argparse
 import subprocess
 import re
 import json
 import time
 import os
+import select
 import threading
-from collections import defaultdict
+from collections import defaultdict, deque
+from runwatch import shared_watcher
+from sipparse import SipFeed, SipStreams
+from sipstore import SipStore, registration_ttl
+from pktcapture import PacketRing
+from ctnetlink import Conntrack
+from latencyhist import LatencyHistogram
+from flowtable import Flow, FlowDeltas, FlowTable, MediaFlow, SpaceSaving, ip_int, ip_str, pack_key
 
 FLOW_FILE = '/run/pathsteer/flows.json'
 SIP_FILE = '/run/pathsteer/sip.json'
+CONFIG_FILE = os.environ.get('CONFIG_FILE', '/etc/pathsteer/config.json')
 
 lock = threading.Lock()
 
 # SIP calls (unencrypted only)
-sip_calls = {}
-sip_regs = {}
+# Bounded stores (LRU by last update); ringing/ended calls and
+# registrations carry deadlines, registrations from their Expires
+CALL_CAPACITY = 2000
+REG_CAPACITY = 5000
+RINGING_TTL = 300
+ENDED_TTL = 120
+sip_calls = SipStore(CALL_CAPACITY, on_evict=lambda k, c: forget_media(k))
+sip_regs = SipStore(REG_CAPACITY)
 
-# All flows: keyed by (proto, src_ip, src_port, dst_ip, dst_port)
-flows = {}
+# All flows: keyed by pack_key(proto, src_ip, src_port, dst_ip, dst_port)
+flows = FlowTable()
 failover_count = 0
 prev_active = None
+capture_ring = None
+# SIP-port packets from the ring, forwarded to sip-monitor (dropped if it is not running)
+sip_feed = SipFeed()
+
+# Flows that get per-packet rate/jitter/gap tracking (MediaFlow: MediaStats per direction)
+MEDIA_SERVICES = ('RTP/SRTP', 'UDP-Media')
+
+# Media endpoints announced in SDP (c=/m= of INVITE, 18x and 200 OK):
+# (ip << 16 | port) -> (call_id, 'RTP/SRTP' | 'RTCP'), so a new UDP flow
+# is matched to its call with two dict lookups instead of a port guess
+media_index = {}
+call_media = {}     # call_id -> {'endpoints': set, 'flows': {flow key: Flow}}
+# Recent uplink switches with the media flows they affected
+failovers = deque(maxlen=20)
+
+# Failover impact: per mode (TRIPWIRE/MIRROR) and service class, histograms
+# of the silence each flow saw across an uplink switch ('gap': last packet
+# before -> first packet after; 'resume': switch -> first packet after).
+# Persisted so survivability numbers accumulate across restarts.
+IMPACT_FILE = '/opt/pathsteer/data/failover-impact.json'
+IMPACT_SAVE_INTERVAL = 30
+impact = {}
+impact_dirty = False
+
+# Capture threads count packets into a thread-local FlowDeltas and merge
+# into `flows` every MERGE_PACKETS packets or MERGE_INTERVAL seconds
+MERGE_PACKETS = 1024
+MERGE_INTERVAL = 0.05
+_local = threading.local()
+# Ranked views for flows.json, chosen by config "flow_monitor": {"views": [...], "top_k": N}.
+# The first view fills 'flows'; the rest go under 'top'. Heavy hitters are
+# tracked with Space-Saving sketches so ranking never sorts the full table.
+FLOW_VIEWS = ('recent', 'bytes', 'rate', 'failovers')
+views = ['recent']
+top_k = 20
+top_bytes = SpaceSaving(512)
+top_rate = SpaceSaving(512)      # packets in the current write interval
+top_failovers = SpaceSaving(512)
+rate_window_start = time.time()
+
+merge_stats = {'merges': 0, 'packets': 0, 'flows': 0, 'last_batch': 0, 'max_batch': 0,
+               'merge_ms': 0.0, 'max_merge_ms': 0.0, 'lock_wait_ms': 0.0, 'max_lock_wait_ms': 0.0}
 
 # Known service signatures
 SERVICES = {
@@ -62,103 +120,359 @@ def identify_service(dst_port, proto, dst_ip):
         return f'Webex:{dst_port}'
     return f'{proto.upper()}:{dst_port}'
 
-def flow_key(proto, src_ip, src_port, dst_ip, dst_port):
-    # Normalize: always use the lower IP as first
-    if src_ip < dst_ip:
-        return f"{proto}|{src_ip}:{src_port}|{dst_ip}:{dst_port}"
-    else:
-        return f"{proto}|{dst_ip}:{dst_port}|{src_ip}:{src_port}"
+def _deltas():
+    d = getattr(_local, 'deltas', None)
+    if d is None:
+        d = _local.deltas = FlowDeltas(MERGE_PACKETS, MERGE_INTERVAL)
+    return d
+
+def _merge(deltas):
+    """Fold one thread's pending deltas into the flow table under a single lock"""
+    pending, count = deltas.take()
+    t0 = time.perf_counter()
+    with lock:
+        t1 = time.perf_counter()
+        for key, (proto, src, sport, dst, dport, packets, nbytes, first, last) in pending.items():
+            f = flows.get(key)
+            if f is None:
+                service = identify_service(dport, proto, ip_str(dst))
+                f = flows.add(key, Flow(proto, src, sport, dst, dport, service, first))
+                f.last_seen = last
+                if media_index and proto == 'udp':
+                    _attach_call(key, f)
+                if f.service in MEDIA_SERVICES:
+                    f.media = deltas.media[key] = MediaFlow(src, sport)
+            else:
+                if f.call is None and media_index and proto == 'udp' and _attach_call(key, f) \
+                        and f.media is None and f.service in MEDIA_SERVICES:
+                    f.media = deltas.media[key] = MediaFlow(src, sport)
+                if f.armed is not None and last >= f.armed[0]:
+                    _record_impact(f, first, last)
+                flows.touch(key, f, last)
+            f.packets += packets
+            f.bytes += nbytes
+            top_bytes.add(key, nbytes)
+            top_rate.add(key, packets)
+        held = (time.perf_counter() - t1) * 1000
+        wait = (t1 - t0) * 1000
+        m = merge_stats
+        m['merges'] += 1
+        m['packets'] += count
+        m['flows'] += len(pending)
+        m['last_batch'] = count
+        m['max_batch'] = max(m['max_batch'], count)
+        m['merge_ms'] += held
+        m['max_merge_ms'] = max(m['max_merge_ms'], held)
+        m['lock_wait_ms'] += wait
+        m['max_lock_wait_ms'] = max(m['max_lock_wait_ms'], wait)
+        if m['merges'] % 200 == 0:
+            # Media trackers of flows that have left the table
+            for key in [k for k in deltas.media if flows.get(k) is None]:
+                del deltas.media[key]
 
 def update_flow(proto, src_ip, src_port, dst_ip, dst_port, pkt_len):
-    key = flow_key(proto, src_ip, src_port, dst_ip, dst_port)
+    deltas = _deltas()
+    if deltas.add(proto, ip_int(src_ip), src_port, ip_int(dst_ip), dst_port, pkt_len, time.time()):
+        _merge(deltas)
+
+def flush_deltas():
+    """Merge this thread's pending deltas once they are due, packets or not"""
+    deltas = _deltas()
+    if deltas.due(time.time()):
+        _merge(deltas)
+
+def _resolve_armed(f, now):
+    """Conntrack saw activity on an armed flow: that is its first sign of life
+    since the failover.  Counters arrive per event or dump (CONNTRACK_DUMP_INTERVAL),
+    so gap and resume are upper bounds at that granularity."""
+    if f.armed is not None and now >= f.armed[0]:
+        _record_impact(f, now, now)
+
+def _apply_conntrack(entry, now, event):
+    """Set a flow's counters from a conntrack entry; caller holds lock.
+
+    Conntrack knows the real original direction, so src is always the
+    initiator (the key still goes through pack_key() so ring and tcpdump
+    sources agree on identity).
+    """
+    if entry['src'] in MGMT_HOSTS or entry['dst'] in MGMT_HOSTS:
+        return
+    proto, sport, dport = entry['proto'], entry['sport'], entry['dport']
+    src, dst = ip_int(entry['src']), ip_int(entry['dst'])
+    key = pack_key(proto, src, sport, dst, dport)
+    f = flows.get(key)
+    if f is None:
+        f = flows.add(key, Flow(proto, src, sport, dst, dport,
+                                identify_service(dport, proto, entry['dst']), now))
+    if f.extra is None:
+        f.extra = {}
+    x = f.extra
+    x['direction'] = 'orig'
+    if entry['tcp_state']:
+        x['tcp_state'] = entry['tcp_state']
+    if entry['packets_orig'] is not None:
+        packets = entry['packets_orig'] + (entry['packets_reply'] or 0)
+        if packets != f.packets:
+            _resolve_armed(f, now)
+            flows.touch(key, f, now)
+        nbytes = entry['bytes_orig'] + (entry['bytes_reply'] or 0)
+        if packets > f.packets:
+            top_rate.add(key, packets - f.packets)
+        if nbytes > f.bytes:
+            top_bytes.add(key, nbytes - f.bytes)
+        f.packets = packets
+        f.bytes = nbytes
+        x['packets_orig'], x['packets_reply'] = entry['packets_orig'], entry['packets_reply']
+        x['bytes_orig'], x['bytes_reply'] = entry['bytes_orig'], entry['bytes_reply']
+    elif event in ('new', 'update'):
+        _resolve_armed(f, now)
+        flows.touch(key, f, now)
+    if event == 'destroy':
+        flows.deactivate(key)
+        if proto == 'tcp':
+            x['tcp_state'] = 'CLOSED'
+
+def update_flows(batch):
+    """Account a batch of PacketRing tuples (stamped with kernel time); merges when due.
+
+    An empty batch just gives pending deltas a chance to age out.
+    """
     now = time.time()
-    with lock:
-        if key not in flows:
-            service = identify_service(dst_port, proto, dst_ip)
-            flows[key] = {
-                'proto': proto,
-                'src': f"{src_ip}:{src_port}",
-                'dst': f"{dst_ip}:{dst_port}",
-                'service': service,
-                'packets': 0,
-                'bytes': 0,
-                'start': now,
-                'last_seen': now,
-                'failovers_survived': 0,
-                'active': True
-            }
-        f = flows[key]
-        f['packets'] += 1
-        f['bytes'] += pkt_len
-        f['last_seen'] = now
-        f['active'] = True
-
-def parse_sip_payload(text):
-    """Parse SIP from packet payload"""
-    method = None
-    m = re.search(r'^(INVITE|BYE|REGISTER|ACK|CANCEL) ', text, re.M)
-    if m:
-        method = m.group(1)
-    status = None
-    m = re.search(r'^SIP/2\.0 (\d{3})', text, re.M)
-    if m:
-        status = int(m.group(1))
-    call_id = None
-    m = re.search(r'Call-ID:\s*(.+)', text, re.I)
-    if m:
-        call_id = m.group(1).strip()
-    from_uri = None
-    m = re.search(r'From:.*?sip:([^>;@\s]+)', text, re.I)
-    if m:
-        from_uri = m.group(1)
-    to_uri = None
-    m = re.search(r'To:.*?sip:([^>;@\s]+)', text, re.I)
-    if m:
-        to_uri = m.group(1)
-    return method, status, call_id, from_uri, to_uri
+    deltas = _deltas()
+    add = deltas.add
+    for pkt in batch:
+        add(pkt[0], pkt[1], pkt[2], pkt[3], pkt[4], pkt[5], pkt[7])
+    if deltas.due(now):
+        _merge(deltas)
+
+def merge_summary():
+    """merge_stats plus averages; caller holds lock"""
+    m = dict(merge_stats)
+    n = m['merges'] or 1
+    m['avg_batch'] = round(m['packets'] / n, 1)
+    m['avg_merge_ms'] = round(m['merge_ms'] / n, 3)
+    m['avg_lock_wait_ms'] = round(m['lock_wait_ms'] / n, 3)
+    m['packets_per_flow'] = round(m['packets'] / (m['flows'] or 1), 1)
+    for k in ('merge_ms', 'max_merge_ms', 'lock_wait_ms', 'max_lock_wait_ms'):
+        m[k] = round(m[k], 3)
+    return m
+
+sip_streams = SipStreams()
+
+def register_media(call_id, msg):
+    """Index the RTP/RTCP endpoints of an SDP body; caller holds lock"""
+    cm = call_media.setdefault(call_id, {'endpoints': set(), 'flows': {}})
+    for kind, addr, port, proto in msg.media:
+        if not addr or not port:
+            continue
+        try:
+            ip = ip_int(addr)
+        except OSError:
+            continue            # IPv6 or a hostname
+        for ep, service in ((ip << 16 | port, 'RTP/SRTP'), (ip << 16 | (port + 1), 'RTCP')):
+            media_index[ep] = (call_id, service)
+            cm['endpoints'].add(ep)
+
+def forget_media(call_id):
+    """caller holds lock"""
+    cm = call_media.pop(call_id, None)
+    if cm is None:
+        return
+    for ep in cm['endpoints']:
+        if media_index.get(ep, (None,))[0] == call_id:
+            del media_index[ep]
 
-def process_sip(method, status, call_id, from_uri, to_uri):
+def _attach_call(key, f):
+    """Tie a UDP flow to the call whose SDP announced either endpoint; caller holds lock"""
+    hit = media_index.get(f.src << 16 | f.sport) or media_index.get(f.dst << 16 | f.dport)
+    if hit is None:
+        return False
+    f.call, f.service = hit
+    call_media[f.call]['flows'][key] = f
+    return True
+
+def call_media_summary(call_id):
+    """Packets, rate, jitter, gaps and estimated loss over a call's RTP flows; caller holds lock"""
+    cm = call_media.get(call_id)
+    rtp = [f for f in cm['flows'].values() if f.media is not None] if cm else []
+    stats = [m for f in rtp for m in f.media.streams()]     # one per direction
+    if not stats:
+        return None
+    packets = sum(f.packets for f in rtp)
+    missing = sum(m.missing for m in stats)
+    return {
+        'streams': len(stats),
+        'packets': packets,
+        'pps': round(sum(m.rate for m in stats), 1),
+        'jitter_ms': round(max(m.jitter for m in stats) * 1000, 2),
+        'max_gap_ms': round(max(m.max_gap for m in stats) * 1000, 1),
+        'est_loss_pct': round(100 * missing / (packets + missing), 2) if packets + missing else 0,
+        'failovers_resumed': min(m.resumed for m in stats),
+    }
+
+def handle_sip(pkt):
+    """Decode the SIP messages in one port-5060 packet handed over by the capture engine"""
+    for msg in sip_streams.decode(pkt):
+        process_sip(msg)
+
+def process_sip(msg):
+    call_id, method, status = msg.call_id, msg.method, msg.status
+    from_uri, to_uri = msg.from_user, msg.to_user
     if not call_id:
         return
     now = time.time()
     with lock:
         if method == 'INVITE':
-            sip_calls[call_id] = {
+            sip_calls.put(call_id, {
                 'call_id': call_id[:40],
                 'calling': from_uri or '?',
                 'called': to_uri or '?',
                 'state': 'ringing',
                 'start': now,
-                'updated': now,
                 'failovers_survived': 0
-            }
+            }, now, ttl=RINGING_TTL)
         elif method == 'BYE':
             if call_id in sip_calls:
-                sip_calls[call_id]['state'] = 'ended'
-                sip_calls[call_id]['updated'] = now
+                sip_calls.touch(call_id, now, ttl=ENDED_TTL)['state'] = 'ended'
         elif method == 'CANCEL':
             if call_id in sip_calls:
-                sip_calls[call_id]['state'] = 'cancelled'
-                sip_calls[call_id]['updated'] = now
+                sip_calls.touch(call_id, now, ttl=ENDED_TTL)['state'] = 'cancelled'
         elif method == 'REGISTER':
             if from_uri:
-                sip_regs[from_uri] = {'user': from_uri, 'updated': now}
-        if status == 200 and call_id in sip_calls and sip_calls[call_id]['state'] == 'ringing':
-            sip_calls[call_id]['state'] = 'active'
-            sip_calls[call_id]['updated'] = now
+                ttl = registration_ttl(msg)
+                if ttl:
+                    sip_regs.put(from_uri, {'user': from_uri, 'expires': ttl}, now, ttl=ttl)
+                else:
+                    sip_regs.pop(from_uri)
+        if status == 200 and call_id in sip_calls and sip_calls.get(call_id)['state'] == 'ringing':
+            sip_calls.touch(call_id, now, ttl=None)['state'] = 'active'
+        elif status == 200 and msg.cseq_method == 'REGISTER' and from_uri in sip_regs \
+                and msg.expires is not None:
+            # The registrar's granted lifetime wins over the requested one
+            if msg.expires:
+                sip_regs.touch(from_uri, now, ttl=msg.expires)['expires'] = msg.expires
+            else:
+                sip_regs.pop(from_uri)
+        if msg.media and call_id in sip_calls:
+            register_media(call_id, msg)
+
+def service_class(service):
+    if service in ('RTP/SRTP', 'RTCP'):
+        return 'rtp'
+    if service.startswith('SIP'):
+        return 'sip'
+    if service in ('UDP-Media', 'WebRTC-Sig'):
+        return 'media'
+    if service == 'HTTPS/WSS':
+        return 'https'
+    return 'other'
+
+def _impact_group(mode, cls):
+    groups = impact.setdefault(mode, {})
+    g = groups.get(cls)
+    if g is None:
+        g = groups[cls] = {'flows': 0, 'gap': LatencyHistogram(), 'resume': LatencyHistogram()}
+    return g
+
+def _record_impact(f, first, last):
+    """First packets since an armed failover arrived (first..last); caller holds lock"""
+    global impact_dirty
+    at, mode = f.armed
+    f.armed = None
+    g = _impact_group(mode, service_class(f.service))
+    if first >= at:
+        g['gap'].record(first - f.last_seen)
+        g['resume'].record(first - at)
+    else:
+        # The merged batch straddles the switch: its span bounds the gap
+        g['gap'].record(last - first)
+        g['resume'].record(last - at)
+    impact_dirty = True
+
+def impact_summary():
+    """caller holds lock"""
+    return {mode: {cls: {'flows': g['flows'], 'resumed': g['gap'].count,
+                         'gap': g['gap'].summary(), 'resume': g['resume'].summary()}
+                   for cls, g in groups.items()}
+            for mode, groups in impact.items()}
+
+def load_impact():
+    try:
+        with open(IMPACT_FILE) as f:
+            data = json.load(f)
+    except:
+        return
+    with lock:
+        for mode, groups in data.items():
+            for cls, g in groups.items():
+                impact.setdefault(mode, {})[cls] = {
+                    'flows': g.get('flows', 0),
+                    'gap': LatencyHistogram.from_dict(g.get('gap', {})),
+                    'resume': LatencyHistogram.from_dict(g.get('resume', {})),
+                }
 
-def mark_failover():
-    """Called when active uplink changes - increment survived count on all active flows"""
+def save_impact():
+    global impact_dirty
+    with lock:
+        if not impact_dirty:
+            return
+        data = {mode: {cls: {'flows': g['flows'], 'gap': g['gap'].to_dict(), 'resume': g['resume'].to_dict()}
+                       for cls, g in groups.items()}
+                for mode, groups in impact.items()}
+        impact_dirty = False
+    try:
+        os.makedirs(os.path.dirname(IMPACT_FILE), exist_ok=True)
+        with open(IMPACT_FILE + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.rename(IMPACT_FILE + '.tmp', IMPACT_FILE)
+    except:
+        pass
+
+def mark_failover(old=None, new=None, mode=None):
+    """Called when active uplink changes - increment survived count on all active flows.
+
+    Every recently seen flow is armed so its next packet records the gap
+    across the switch; media flows also record their own interruption.
+    """
     global failover_count
+    now = time.time()
+    mode = mode or 'UNKNOWN'
     with lock:
         failover_count += 1
-        for f in flows.values():
-            if f['active'] and time.time() - f['last_seen'] < 10:
-                f['failovers_survived'] += 1
+        affected = []
+        for key, f in flows.seen_since(now - 10):
+            f.failovers_survived += 1
+            top_failovers.add(key)
+            f.armed = (now, mode)
+            _impact_group(mode, service_class(f.service))['flows'] += 1
+            if f.media is not None:
+                for m in f.media.streams():
+                    m.failover_at = now
+                    affected.append(m)
+        failovers.append({'at': now, 'from': old, 'to': new, 'mode': mode, 'media': affected})
         for c in sip_calls.values():
             if c['state'] == 'active':
                 c['failovers_survived'] += 1
 
+def media_interruptions():
+    """Per-failover media interruption summary; caller holds lock"""
+    out = []
+    for ev in failovers:
+        gaps = [m.interruption for m in ev['media'] if m.interrupted_at == ev['at']]
+        waiting = sum(1 for m in ev['media'] if m.failover_at == ev['at'])
+        out.append({
+            'at': ev['at'],
+            'from': ev['from'],
+            'to': ev['to'],
+            'mode': ev['mode'],
+            'media_flows': len(ev['media']),
+            'resumed': len(gaps),
+            'not_resumed': waiting,
+            'max_interruption_ms': round(max(gaps) * 1000, 1) if gaps else None,
+            'mean_interruption_ms': round(sum(gaps) / len(gaps) * 1000, 1) if gaps else None,
+        })
+    return out
+
 def check_failover():
     """Monitor active uplink for changes"""
     global prev_active
@@ -167,132 +481,255 @@ def check_failover():
             data = json.load(f)
         active = data.get('active_uplink', '')
         if prev_active and active != prev_active:
-            mark_failover()
+            mark_failover(prev_active, active, data.get('mode'))
         prev_active = active
     except:
         pass
 
+def failover_watcher():
+    """Re-check active_uplink whenever pathsteerd rewrites status.json"""
+    watch = shared_watcher()
+    token = watch.token()
+    while True:
+        check_failover()
+        watch.wait(('status.json',), token, timeout=2)
+
+def load_config():
+    """Ranked views and top_k from the flow_monitor section of the node config"""
+    global views, top_k
+    try:
+        with open(CONFIG_FILE) as f:
+            cfg = json.load(f).get('flow_monitor', {})
+    except:
+        cfg = {}
+    views = [v for v in cfg.get('views', views) if v in FLOW_VIEWS] or ['recent']
+    top_k = int(cfg.get('top_k', top_k))
+    for sketch in (top_bytes, top_rate, top_failovers):
+        sketch.capacity = max(sketch.capacity, top_k * 16)
+
+def ranked(view, now):
+    """Top flows for one view; caller holds lock"""
+    if view == 'recent':
+        return [f.as_dict() for f in flows.recent(top_k)]
+    sketch = {'bytes': top_bytes, 'rate': top_rate, 'failovers': top_failovers}[view]
+    out = []
+    elapsed = max(now - rate_window_start, 0.001)
+    for key, count in sketch.top(top_k * 2):
+        f = flows.get(key)
+        if f is None:
+            sketch.discard(key)     # expired out of the table
+            continue
+        if view != 'failovers' and not f.active:
+            continue
+        d = f.as_dict()
+        if view == 'rate':
+            d['pps'] = round(count / elapsed, 1)
+        out.append(d)
+        if len(out) == top_k:
+            break
+    return out
+
 def write_state():
+    global rate_window_start
     now = time.time()
     with lock:
-        # Mark stale flows inactive
-        for f in flows.values():
-            if now - f['last_seen'] > 30:
-                f['active'] = False
-        
-        active_flows = [f for f in flows.values() if f['active']]
-        active_flows.sort(key=lambda x: x['last_seen'], reverse=True)
+        # Age stale flows to inactive and drop long-idle ones
+        flows.expire(now)
         
         active_calls = [c for c in sip_calls.values() if c['state'] == 'active']
-        recent_calls = sorted(sip_calls.values(), key=lambda x: x['updated'], reverse=True)[:10]
+        recent = sip_calls.recent_items(10)
+        recent_calls = [dict(c, media=call_media_summary(k)) for k, c in recent]
         
         state = {
-            'active_flows': len(active_flows),
+            'active_flows': flows.active_count,
             'total_flows': len(flows),
             'active_sip_calls': len(active_calls),
             'registrations': len(sip_regs),
             'failover_count': failover_count,
-            'flows': active_flows[:20],
+            'merge': merge_summary(),
+            'views': views,
+            'flows': ranked(views[0], now),
+            'top': {v: ranked(v, now) for v in views[1:]},
+            'media_interruptions': media_interruptions(),
+            'failover_impact': impact_summary(),
             'sip_calls': recent_calls,
-            'sip_regs': list(sip_regs.values()),
+            'sip_regs': sip_regs.recent(20),
+            'sip_store': {'calls': sip_calls.stats(), 'regs': sip_regs.stats()},
             'updated': now
         }
+        top_rate.reset()
+        rate_window_start = now
     
+    if capture_ring is not None:
+        try:
+            state['capture'] = capture_ring.stats()
+        except OSError:
+            pass
+    state['sip_feed'] = sip_feed.stats()
+
     try:
         with open(FLOW_FILE + '.tmp', 'w') as f:
             json.dump(state, f)
         os.rename(FLOW_FILE + '.tmp', FLOW_FILE)
         # Also write SIP-specific file for backward compat
         with open(SIP_FILE + '.tmp', 'w') as f:
-            json.dump({'active_calls': len(active_calls), 'calls': recent_calls, 'regs': list(sip_regs.values())}, f)
+            json.dump({'active_calls': len(active_calls), 'calls': recent_calls, 'regs': sip_regs.recent(20)}, f)
         os.rename(SIP_FILE + '.tmp', SIP_FILE)
     except:
         pass
 
+SIP_PORTS = (5060,)
+
+# veth management addresses; their traffic is not client flows
+MGMT_HOSTS = ['10.201.10.1', '10.201.10.5', '10.201.10.9', '10.201.10.13',
+              '10.201.10.17', '10.201.10.21', '10.201.10.25']
+
+def run_ring_capture():
+    """Capture inside ns_vip from a TPACKET_V3 ring, one batch per block.
+
+    The one ring feeds every consumer: each packet is accounted to its
+    flow, and SIP-port packets also carry their payload to the SIP parser
+    here and, over the sip-feed socket, to sip-monitor, which no longer
+    opens a capture of its own.
+    """
+    global capture_ring
+    ring = capture_ring = PacketRing('ns_vip', exclude_hosts=MGMT_HOSTS, payload_ports=SIP_PORTS)
+    print("Flow Monitor starting ring capture in ns_vip...")
+    print("Filtering out veth management traffic and ICMP")
+    for batch in ring.batches():
+        update_flows(batch)
+        for pkt in [pkt for pkt in batch if pkt[6] is not None]:
+            handle_sip(pkt)
+            sip_feed.send(pkt)
+
+def run_sip_ring():
+    """SIP-only ring (kernel-filtered to SIP_PORTS) for sources without payloads"""
+    ring = PacketRing('ns_vip', payload_ports=SIP_PORTS, filter_ports=SIP_PORTS, block_size=1 << 18)
+    print("SIP capture starting (kernel-filtered ring)...")
+    for batch in ring.batches():
+        for pkt in batch:
+            if pkt[6]:
+                handle_sip(pkt)
+                sip_feed.send(pkt)
+
+CONNTRACK_DUMP_INTERVAL = 2
+
+def run_conntrack():
+    """Flows from conntrack events in ns_vip, counters from periodic table dumps"""
+    ct = Conntrack('ns_vip')
+    if not ct.enable_accounting():
+        print("Warning: could not enable nf_conntrack_acct; byte/packet counters unavailable")
+    print("Flow Monitor following conntrack events in ns_vip...")
+
+    def dumper():
+        while True:
+            try:
+                entries = ct.dump()
+            except OSError:
+                entries = []
+            now = time.time()
+            with lock:
+                for e in entries:
+                    _apply_conntrack(e, now, None)
+            time.sleep(CONNTRACK_DUMP_INTERVAL)
+    threading.Thread(target=dumper, daemon=True).start()
+
+    for batch in ct.events():
+        now = time.time()
+        with lock:
+            for event, e in batch:
+                if event != 'resync':   # lost events: the next dump reconciles
+                    _apply_conntrack(e, now, event)
+
 def run_capture():
     """Run tcpdump inside ns_vip capturing all traffic"""
     cmd = [
         'ip', 'netns', 'exec', 'ns_vip',
         'tcpdump', '-i', 'any', '-l', '-n', '-q',
+        '-Q', 'in',     # forwarded packets once, as they arrive (not again on egress)
         '-s', '1500',
-        'not', 'host', '10.201.10.1', 'and', 'not', 'host', '10.201.10.5',
-        'and', 'not', 'host', '10.201.10.9', 'and', 'not', 'host', '10.201.10.13',
-        'and', 'not', 'host', '10.201.10.17', 'and', 'not', 'host', '10.201.10.21',
-        'and', 'not', 'host', '10.201.10.25',
-        'and', 'not', 'icmp',
     ]
+    for i, host in enumerate(MGMT_HOSTS):
+        cmd += (['and'] if i else []) + ['not', 'host', host]
+    cmd += ['and', 'not', 'icmp']
     
     print("Flow Monitor starting capture in ns_vip...")
     print("Filtering out veth management traffic and ICMP")
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
     
-    for line in proc.stdout:
-        line = line.rstrip()
-        # Parse tcpdump -q output: timestamp IP src.port > dst.port: proto, length N
-        # TCP: 11:33:56.283713 IP 104.204.136.50.49654 > 192.73.248.83.443: tcp 0
-        # UDP: 11:33:58.015510 IP 104.204.136.50.41641 > 176.58.93.248.3478: UDP, length 40
-        
-        m = re.match(r'[\d:.]+\s+IP\s+(\d+\.\d+\.\d+\.\d+)\.(\d+)\s+>\s+(\d+\.\d+\.\d+\.\d+)\.(\d+):\s+(tcp|UDP)', line)
-        if m:
-            src_ip, src_port, dst_ip, dst_port = m.group(1), int(m.group(2)), m.group(3), int(m.group(4))
-            proto = 'tcp' if m.group(5) == 'tcp' else 'udp'
-            pkt_len = 0
-            lm = re.search(r'length (\d+)', line)
-            if lm:
-                pkt_len = int(lm.group(1))
-            update_flow(proto, src_ip, src_port, dst_ip, dst_port, pkt_len)
-
-def run_sip_capture():
-    """Separate capture for SIP payload parsing"""
-    cmd = [
-        'ip', 'netns', 'exec', 'ns_vip',
-        'tcpdump', '-i', 'any', '-l', '-A', '-s', '0',
-        'udp port 5060 or tcp port 5060',
-    ]
-    print("SIP deep capture starting...")
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1)
+    # select() with a timeout instead of iterating stdout, so deltas still
+    # merge (and failover impact resolves) after the last packet of a burst
+    fd = proc.stdout.fileno()
+    buf = b''
+    while True:
+        ready, _, _ = select.select([fd], [], [], MERGE_INTERVAL)
+        if not ready:
+            flush_deltas()
+            continue
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        *lines, buf = (buf + chunk).split(b'\n')
+        for line in lines:
+            parse_tcpdump_line(line.decode('utf-8', 'replace').rstrip())
+        flush_deltas()
+
+def parse_tcpdump_line(line):
+    """Account one line of tcpdump -q output"""
+    # Parse tcpdump -q output: timestamp IP src.port > dst.port: proto, length N
+    # TCP: 11:33:56.283713 IP 104.204.136.50.49654 > 192.73.248.83.443: tcp 0
+    # UDP: 11:33:58.015510 IP 104.204.136.50.41641 > 176.58.93.248.3478: UDP, length 40
     
-    sip_buffer = []
-    for line in proc.stdout:
-        line = line.rstrip()
-        if any(m in line for m in ['INVITE sip:', 'BYE sip:', 'REGISTER sip:', 'SIP/2.0 ', 'CANCEL sip:']):
-            if sip_buffer:
-                method, status, call_id, from_uri, to_uri = parse_sip_payload('\n'.join(sip_buffer))
-                if method or status:
-                    process_sip(method, status, call_id, from_uri, to_uri)
-            sip_buffer = [line]
-        elif sip_buffer:
-            if line == '':
-                method, status, call_id, from_uri, to_uri = parse_sip_payload('\n'.join(sip_buffer))
-                if method or status:
-                    process_sip(method, status, call_id, from_uri, to_uri)
-                sip_buffer = []
-            else:
-                sip_buffer.append(line)
+    m = re.match(r'[\d:.]+\s+IP\s+(\d+\.\d+\.\d+\.\d+)\.(\d+)\s+>\s+(\d+\.\d+\.\d+\.\d+)\.(\d+):\s+(tcp|UDP)', line)
+    if m:
+        src_ip, src_port, dst_ip, dst_port = m.group(1), int(m.group(2)), m.group(3), int(m.group(4))
+        proto = 'tcp' if m.group(5) == 'tcp' else 'udp'
+        pkt_len = 0
+        lm = re.search(r'length (\d+)', line)
+        if lm:
+            pkt_len = int(lm.group(1))
+        update_flow(proto, src_ip, src_port, dst_ip, dst_port, pkt_len)
 
 def periodic():
+    last_save = time.time()
     while True:
-        check_failover()
         write_state()
-        # Cleanup old flows
+        if time.time() - last_save >= IMPACT_SAVE_INTERVAL:
+            save_impact()
+            last_save = time.time()
+        # Cleanup old calls (flows expire in write_state)
         with lock:
-            old = [k for k, v in flows.items() if not v['active'] and time.time() - v['last_seen'] > 300]
-            for k in old:
-                del flows[k]
-            old_calls = [k for k, v in sip_calls.items() if v['state'] in ('ended', 'cancelled') and time.time() - v['updated'] > 120]
-            for k in old_calls:
-                del sip_calls[k]
+            now = time.time()
+            for k, _ in sip_calls.expire(now):
+                forget_media(k)
+            sip_regs.expire(now)
         time.sleep(2)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PathSteer flow monitor')
+    parser.add_argument('--source', choices=['ring', 'conntrack', 'tcpdump'], default='ring',
+                        help='flow source: AF_PACKET ring (default), kernel conntrack, or tcpdump text')
+    args = parser.parse_args()
+
     os.makedirs('/run/pathsteer', exist_ok=True)
+    load_config()
+    load_impact()
     write_state()
     
-    # Periodic writer + failover checker
+    # Periodic writer
     threading.Thread(target=periodic, daemon=True).start()
+
+    # Failover detection, woken by status.json changes
+    threading.Thread(target=failover_watcher, daemon=True).start()
     
-    # SIP deep parser (separate tcpdump for payload)
-    threading.Thread(target=run_sip_capture, daemon=True).start()
-    
+    # SIP payloads come from the main ring; other sources need their own
+    if args.source != 'ring':
+        threading.Thread(target=run_sip_ring, daemon=True).start()
+
     # Main flow tracker
-    run_capture()
+    if args.source == 'tcpdump':
+        run_capture()
+    elif args.source == 'conntrack':
+        run_conntrack()
+    else:
+        run_ring_capture()
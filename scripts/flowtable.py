@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+"""
+PathSteer compact flow table
+
+Flows are keyed by a single int packing (proto, ip, port, ip, port) with
+the endpoints in canonical order, so both directions of a conversation hit
+the same entry.  Records are __slots__ objects with IPs kept as ints and
+only formatted when written out.
+
+Two last-seen ordered indexes replace the full-table scans:
+  - active: every touch moves the flow to the tail, so the head is always
+    the least recently seen flow; going idle pops from the head
+  - idle: flows in the order they went idle; deletion pops from the head
+Expiry therefore costs O(flows that changed state), and "newest active
+flows" walks back from the tail only as far as it needs to.
+"""
+import heapq
+import socket
+import struct
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
+
+ACTIVE_TIMEOUT = 30     # no packets for this long -> inactive
+IDLE_TIMEOUT = 300      # inactive for this long -> dropped
+MAX_FLOWS = 250000
+
+PROTO_NUM = {'tcp': 6, 'udp': 17}
+_IP = struct.Struct('!I')
+
+
+def ip_int(s):
+    return _IP.unpack(socket.inet_aton(s))[0]
+
+
+@lru_cache(maxsize=65536)
+def ip_str(n):
+    return socket.inet_ntoa(_IP.pack(n))
+
+
+def pack_key(proto, src, sport, dst, dport):
+    """Direction-independent int key; src/dst are IPv4 ints"""
+    if (src, sport) > (dst, dport):
+        src, sport, dst, dport = dst, dport, src, sport
+    return PROTO_NUM[proto] << 96 | src << 64 | sport << 48 | dst << 16 | dport
+
+
+class Flow:
+    __slots__ = ('proto', 'src', 'sport', 'dst', 'dport', 'service', 'packets', 'bytes',
+                 'start', 'last_seen', 'failovers_survived', 'active', 'extra', 'media', 'armed', 'call')
+
+    def __init__(self, proto, src, sport, dst, dport, service, now):
+        self.proto = proto
+        self.src = src
+        self.sport = sport
+        self.dst = dst
+        self.dport = dport
+        self.service = service
+        self.packets = 0
+        self.bytes = 0
+        self.start = now
+        self.last_seen = now
+        self.failovers_survived = 0
+        self.active = True
+        self.extra = None       # source-specific fields (conntrack state, ...)
+        self.media = None       # MediaFlow for RTP/UDP media flows
+        self.armed = None       # (failover time, mode) until the flow's next packet
+        self.call = None        # SIP Call-ID when SDP announced this flow's endpoints
+
+    def as_dict(self):
+        d = {
+            'proto': self.proto,
+            'src': f"{ip_str(self.src)}:{self.sport}",
+            'dst': f"{ip_str(self.dst)}:{self.dport}",
+            'service': self.service,
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'start': self.start,
+            'last_seen': self.last_seen,
+            'failovers_survived': self.failovers_survived,
+            'active': self.active,
+        }
+        if self.extra:
+            d.update(self.extra)
+        if self.media is not None:
+            d['media'] = self.media.as_dict(self.last_seen)
+        if self.call is not None:
+            d['call_id'] = self.call[:40]
+        return d
+
+
+class MediaStats:
+    """Arrival-time statistics for one media flow, constant memory.
+
+    Updated per packet by the capture thread:
+      - rate: 1 / EWMA of inter-arrival time (packets/s)
+      - jitter: RFC 3550 estimator J += (|D| - J) / 16, with D taken as the
+        change in inter-arrival time (SRTP hides RTP timestamps, so the
+        sender clock is assumed to tick at the packetization interval)
+      - max_gap: longest silence between two packets
+      - missing: packets presumed lost, from gaps of several packetization
+        intervals (RTP sequence numbers are not captured)
+    A failover arms failover_at; the first packet after it records the
+    silence that spanned the switch as the media interruption.
+    One MediaStats covers one direction of a flow (see MediaFlow); a copy
+    of the previous packet arriving within DUP_WINDOW - the same packet
+    captured again on the far side of a forwarding hop - is ignored.
+    """
+    __slots__ = ('last', 'iat', 'avg_iat', 'jitter', 'max_gap', 'missing', 'failover_at',
+                 'interruption', 'interrupted_at', 'resumed')
+
+    IAT_ALPHA = 1 / 16
+    DUP_WINDOW = 0.0005
+
+    def __init__(self, now):
+        self.last = now
+        self.iat = None
+        self.avg_iat = None
+        self.jitter = 0.0
+        self.max_gap = 0.0
+        self.missing = 0
+        self.failover_at = 0
+        self.interruption = None
+        self.interrupted_at = 0
+        self.resumed = 0
+
+    def packet(self, ts):
+        iat = ts - self.last
+        if iat < self.DUP_WINDOW:
+            return
+        if self.failover_at and ts >= self.failover_at:
+            self.interruption = iat
+            self.interrupted_at = self.failover_at
+            self.failover_at = 0
+            self.resumed += 1
+        if iat > self.max_gap:
+            self.max_gap = iat
+        if self.iat is not None:
+            if iat > 1.5 * self.avg_iat > 0:
+                self.missing += round(iat / self.avg_iat) - 1
+            self.jitter += (abs(iat - self.iat) - self.jitter) / 16
+            self.avg_iat += (iat - self.avg_iat) * self.IAT_ALPHA
+        else:
+            self.avg_iat = iat
+        self.iat = iat
+        self.last = ts
+
+    @property
+    def rate(self):
+        return 1 / self.avg_iat if self.avg_iat else 0.0
+
+    def as_dict(self, now):
+        return {
+            'pps': round(self.rate, 1),
+            'jitter_ms': round(self.jitter * 1000, 2),
+            'max_gap_ms': round(self.max_gap * 1000, 1),
+            'missing': self.missing,
+            'interruption_ms': None if self.interruption is None else round(self.interruption * 1000, 1),
+        }
+
+
+class MediaFlow:
+    """Per-direction MediaStats for one media flow.
+
+    Flows are keyed direction-independently, but the two directions of a
+    call are separate streams: merged, their interleaved arrivals double
+    the rate, turn the offset between them into jitter, and one side's
+    packets hide an outage on the other.  fwd is flow src -> dst, rev the
+    reply direction; each is created by its first packet.
+    """
+    __slots__ = ('src', 'sport', 'fwd', 'rev')
+
+    def __init__(self, src, sport):
+        self.src = src
+        self.sport = sport
+        self.fwd = None
+        self.rev = None
+
+    def packet(self, src, sport, ts):
+        if src == self.src and sport == self.sport:
+            if self.fwd is None:
+                self.fwd = MediaStats(ts)
+            else:
+                self.fwd.packet(ts)
+        elif self.rev is None:
+            self.rev = MediaStats(ts)
+        else:
+            self.rev.packet(ts)
+
+    def streams(self):
+        """The directions that have carried packets"""
+        return [m for m in (self.fwd, self.rev) if m is not None]
+
+    def as_dict(self, now):
+        return {d: m.as_dict(now) for d, m in (('fwd', self.fwd), ('rev', self.rev)) if m is not None}
+
+
+class FlowTable:
+    """Flows split into active/idle last-seen ordered indexes. Not thread-safe."""
+
+    def __init__(self, active_timeout=ACTIVE_TIMEOUT, idle_timeout=IDLE_TIMEOUT,
+                 max_flows=MAX_FLOWS):
+        self.active_timeout = active_timeout
+        self.idle_timeout = idle_timeout
+        self.max_flows = max_flows
+        self._active = OrderedDict()
+        self._idle = OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._active) + len(self._idle)
+
+    @property
+    def active_count(self):
+        return len(self._active)
+
+    def get(self, key):
+        f = self._active.get(key)
+        return f if f is not None else self._idle.get(key)
+
+    def add(self, key, flow):
+        """Insert a new flow at the tail of the active index"""
+        if len(self) >= self.max_flows:
+            self._evict()
+        self._active[key] = flow
+        return flow
+
+    def touch(self, key, flow, now):
+        """Record activity on an existing flow"""
+        flow.last_seen = now
+        if flow.active:
+            self._active.move_to_end(key)
+        else:
+            del self._idle[key]
+            flow.active = True
+            self._active[key] = flow
+
+    def deactivate(self, key):
+        """Move a flow to idle ahead of its timeout (e.g. conntrack destroy)"""
+        flow = self._active.pop(key, None)
+        if flow is not None:
+            flow.active = False
+            self._idle[key] = flow
+
+    def expire(self, now):
+        """Age active -> idle -> gone; returns (went_idle, removed)"""
+        went_idle = removed = 0
+        cutoff = now - self.active_timeout
+        active = self._active
+        while active:
+            key, flow = next(iter(active.items()))
+            if flow.last_seen > cutoff:
+                break
+            active.popitem(last=False)
+            flow.active = False
+            self._idle[key] = flow
+            went_idle += 1
+        # Flows deactivated early can sit ahead of older ones; they only
+        # delay removal of what is behind them, never keep it forever
+        cutoff = now - self.idle_timeout
+        idle = self._idle
+        while idle:
+            flow = next(iter(idle.values()))
+            if flow.last_seen > cutoff:
+                break
+            idle.popitem(last=False)
+            removed += 1
+        return went_idle, removed
+
+    def _evict(self):
+        index = self._idle if self._idle else self._active
+        index.popitem(last=False)
+        self.evicted += 1
+
+    def recent(self, n):
+        """The n most recently seen active flows, newest first"""
+        return list(islice(reversed(self._active.values()), n))
+
+    def seen_since(self, t):
+        """(key, flow) for active flows with last_seen >= t, newest first"""
+        for key, flow in reversed(self._active.items()):
+            if flow.last_seen < t:
+                break
+            yield key, flow
+
+    def active_flows(self):
+        return self._active.values()
+
+    def items(self):
+        yield from self._active.items()
+        yield from self._idle.items()
+
+
+class FlowDeltas:
+    """Packet counts accumulated by one capture thread between merges.
+
+    Only the owning thread touches it, so adding a packet takes no lock;
+    add() returns True once max_packets have been seen or the oldest
+    pending packet is max_age seconds old, and the caller then merges
+    take() into the shared table under a single lock acquisition.
+    """
+
+    def __init__(self, max_packets=1024, max_age=0.05):
+        self.max_packets = max_packets
+        self.max_age = max_age
+        self.pending = {}       # key -> [proto, src, sport, dst, dport, packets, bytes, first, last]
+        self.media = {}         # key -> MediaFlow, kept across merges; fed per packet
+        self.count = 0
+        self.opened = 0
+
+    def add(self, proto, src, sport, dst, dport, length, now):
+        key = pack_key(proto, src, sport, dst, dport)
+        m = self.media.get(key)
+        if m is not None:
+            m.packet(src, sport, now)
+        d = self.pending.get(key)
+        if d is None:
+            if not self.count:
+                self.opened = now
+            self.pending[key] = [proto, src, sport, dst, dport, 1, length, now, now]
+        else:
+            d[5] += 1
+            d[6] += length
+            d[8] = now
+        self.count += 1
+        return self.count >= self.max_packets or now - self.opened >= self.max_age
+
+    def due(self, now):
+        return self.count > 0 and (self.count >= self.max_packets or now - self.opened >= self.max_age)
+
+    def take(self):
+        pending, count = self.pending, self.count
+        self.pending, self.count = {}, 0
+        return pending, count
+
+
+class SpaceSaving:
+    """Space-Saving heavy-hitter sketch (Metwally et al.) with fixed capacity.
+
+    Keeps at most `capacity` counters. A key that is not tracked replaces
+    the smallest counter and inherits its count, so every key whose true
+    weight exceeds total/capacity is guaranteed to be present, and counts
+    overestimate by at most the inherited floor (kept in errors).  The
+    min-heap is updated lazily: increments leave stale entries that are
+    refreshed when they reach the top.
+    """
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, weight=1):
+        counts = self.counts
+        c = counts.get(key)
+        if c is not None:
+            counts[key] = c + weight
+            return
+        floor = 0
+        if len(counts) >= self.capacity:
+            floor, victim = self._pop_min()
+            del counts[victim], self.errors[victim]
+        counts[key] = floor + weight
+        self.errors[key] = floor
+        heapq.heappush(self._heap, (floor + weight, key))
+        if len(self._heap) > 2 * self.capacity:
+            self._heap = [(c, k) for k, c in counts.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        heap, counts = self._heap, self.counts
+        while True:
+            c, key = heapq.heappop(heap)
+            cur = counts.get(key)
+            if cur == c:
+                return c, key
+            if cur is not None:
+                heapq.heappush(heap, (cur, key))
+
+    def discard(self, key):
+        """Forget key (its heap entry is dropped lazily)"""
+        if self.counts.pop(key, None) is not None:
+            del self.errors[key]
+
+    def top(self, n):
+        """[(key, count)] for the n largest counters, largest first"""
+        return heapq.nlargest(n, self.counts.items(), key=itemgetter(1))
+
+    def reset(self):
+        self.counts.clear()
+        self.errors.clear()
+        self._heap = []
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+PathSteer heat map tiles
+
+Pre-aggregated signal/risk cells for /api/heatmap, kept in training.db
+next to the samples they summarize.  A cell is a Web Mercator (slippy map)
+tile x/y at one of ZOOMS, per uplink:
+  - cell_a / cell_b: that modem's own RSRP, SINR and RTT at the location,
+    whichever uplink was carrying traffic
+  - active: the metrics of the uplink that was active when sampled
+Each cell holds the sample count, mean and p10 of RSRP, SINR, RTT and
+risk.  p10 comes from a sparse fixed-width histogram per metric (stored
+as JSON in the row), so cells merge new samples without the raw rows.
+
+training-collect.sh inserts samples through the sqlite3 CLI, so the tiler
+follows the table by rowid: every pass reads the samples past the last one
+it folded in, updates the touched cells and advances the cursor in the
+same transaction.  Tiles are cumulative - the collector's 14 day cleanup
+of re-sampled spots does not subtract from them.  The cursor also records
+the timestamp of the sample it points at; if training.db is recreated or
+restored (cursor past MAX(rowid), or that rowid now holds another sample)
+the tiles are dropped and rebuilt from the start.
+
+    tiler = HeatTiler(shared_db())
+    tiler.start()
+    tiler.tiles(zoom=14, bbox=(min_lat, min_lon, max_lat, max_lon), uplink='cell_a')
+"""
+import json
+import math
+import threading
+import time
+
+ZOOMS = (10, 12, 14, 16, 18)    # z18 cells are ~150 m, about the collector's spacing
+UPLINKS = ('cell_a', 'cell_b', 'active')
+# Histogram bin width per metric (dB, dB, ms, risk 0..1)
+BINS = {'rsrp': 1.0, 'sinr': 1.0, 'rtt': 5.0, 'risk': 0.01}
+CHUNK = 5000            # samples folded per pass (backfill catches up over several)
+INTERVAL = 10           # collector writes at most every 5 s
+MAX_TILES = 5000
+MAX_LAT = 85.05112878
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS heat_tiles (
+        zoom INTEGER, uplink TEXT, x INTEGER, y INTEGER, n INTEGER,
+        rsrp_mean REAL, rsrp_p10 REAL, sinr_mean REAL, sinr_p10 REAL,
+        rtt_mean REAL, rtt_p10 REAL, risk_mean REAL, risk_p10 REAL,
+        hist TEXT, updated REAL,
+        PRIMARY KEY (zoom, uplink, x, y)
+    ) WITHOUT ROWID''',
+    'CREATE TABLE IF NOT EXISTS heat_tiles_state (key TEXT PRIMARY KEY, value)',
+)
+
+UPSERT = '''INSERT OR REPLACE INTO heat_tiles VALUES
+    (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+
+# === Tile math ===
+
+def tile_xy(lat, lon, zoom):
+    """Slippy map tile containing lat/lon"""
+    lat = max(-MAX_LAT, min(MAX_LAT, lat))
+    n = 1 << zoom
+    x = int((lon + 180.0) / 360.0 * n)
+    s = math.sin(math.radians(lat))
+    y = int((0.5 - math.log((1 + s) / (1 - s)) / (4 * math.pi)) * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_center(x, y, zoom):
+    n = 1 << zoom
+    lon = (x + 0.5) / n * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 0.5) / n))))
+    return lat, lon
+
+
+def quadkey(x, y, zoom):
+    digits = []
+    for i in range(zoom, 0, -1):
+        mask = 1 << (i - 1)
+        digits.append(str((1 if x & mask else 0) + (2 if y & mask else 0)))
+    return ''.join(digits)
+
+
+def snap_zoom(zoom):
+    """Nearest stored level at or below zoom (the coarsest if below all)"""
+    levels = [z for z in ZOOMS if z <= zoom]
+    return levels[-1] if levels else ZOOMS[0]
+
+
+# === Cell aggregates ===
+
+class Cell:
+    """Sample count plus per-metric sum/count/histogram for one tile"""
+    __slots__ = ('n', 'stats')
+
+    def __init__(self, hist=None):
+        self.n = 0
+        self.stats = {}         # metric -> [sum, count, {bin: count}]
+        if hist:
+            d = json.loads(hist)
+            self.n = d['n']
+            self.stats = {m: [s[0], s[1], {int(b): c for b, c in s[2].items()}]
+                          for m, s in d['stats'].items()}
+
+    def add(self, values):
+        self.n += 1
+        for m, v in values.items():
+            s = self.stats.get(m)
+            if s is None:
+                s = self.stats[m] = [0.0, 0, {}]
+            s[0] += v
+            s[1] += 1
+            b = math.floor(v / BINS[m])
+            s[2][b] = s[2].get(b, 0) + 1
+
+    def mean(self, m):
+        s = self.stats.get(m)
+        return round(s[0] / s[1], 2) if s else None
+
+    def p10(self, m):
+        """Lower edge of the bin holding the 10th percentile"""
+        s = self.stats.get(m)
+        if not s:
+            return None
+        rank = max(1, math.ceil(s[1] * 0.1))
+        seen = 0
+        for b in sorted(s[2]):
+            seen += s[2][b]
+            if seen >= rank:
+                return round(b * BINS[m], 2)
+
+    def row(self, zoom, uplink, x, y, now):
+        return (zoom, uplink, x, y, self.n,
+                self.mean('rsrp'), self.p10('rsrp'), self.mean('sinr'), self.p10('sinr'),
+                self.mean('rtt'), self.p10('rtt'), self.mean('risk'), self.p10('risk'),
+                json.dumps({'n': self.n, 'stats': self.stats}, separators=(',', ':')), now)
+
+
+def _radio(rsrp, sinr, rtt):
+    """Metric dict for one modem; the collector writes 0 for 'no reading'"""
+    values = {}
+    if rsrp:
+        values['rsrp'] = rsrp
+        if sinr is not None:
+            values['sinr'] = sinr
+    if rtt and rtt > 0:
+        values['rtt'] = rtt
+    return values
+
+
+def sample_metrics(row):
+    """(rowid, lat, lon, risk, active_uplink, a_rsrp, a_sinr, a_rtt, b_rsrp, b_sinr, b_rtt, ...)
+    -> {uplink: {metric: value}}"""
+    risk, active = row[3], row[4]
+    out = {'cell_a': _radio(row[5], row[6], row[7]),
+           'cell_b': _radio(row[8], row[9], row[10])}
+    # cell_a=TMO, cell_b=ATT; other uplinks carry no radio readings
+    out['active'] = dict(out.get(active, {}))
+    if active not in ('cell_a', 'cell_b'):
+        rtt = row[7] or row[10]
+        if rtt:
+            out['active']['rtt'] = rtt
+    if risk is not None:
+        for uplink, values in out.items():
+            # Risk is global: it rides along on cells that have readings of their own
+            if values or uplink == 'active':
+                values['risk'] = risk
+    return out
+
+
+# === Tiler ===
+
+class HeatTiler:
+    def __init__(self, db, zooms=ZOOMS, chunk=CHUNK, interval=INTERVAL):
+        self.db = db
+        self.zooms = zooms
+        self.chunk = chunk
+        self.interval = interval
+        self._lock = threading.Lock()   # one pass at a time
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._schema = False
+        self.cursor = None
+        self.cursor_ts = None
+        self.samples = 0
+        self.passes = 0
+        self.cells_written = 0
+        self.rebuilds = 0
+        self.last_pass_ms = None
+        self.last_error = None
+
+    def _ensure_schema(self):
+        if not self._schema:
+            self.db.write_many([(sql, ()) for sql in SCHEMA])
+            self._schema = True
+        if self.cursor is None:
+            # A timed-out pass may still be queued behind the writer; let it land
+            # (or fail) before trusting the stored cursor, or it gets folded twice
+            if not self.db.flush(timeout=30):
+                raise RuntimeError('previous tile write still pending')
+            state = dict(self.db.query('SELECT key, value FROM heat_tiles_state'))
+            self.cursor = state.get('last_rowid') or 0
+            self.cursor_ts = state.get('last_ts')
+
+    def _check_cursor(self):
+        """Rebuild if samples no longer continue from the cursor (db recreated or restored)"""
+        if not self.cursor:
+            return
+        top = self.db.query('SELECT MAX(rowid) FROM samples')[0][0] or 0
+        row = self.db.query('SELECT timestamp FROM samples WHERE rowid = ?', (self.cursor,))
+        replaced = row and self.cursor_ts is not None and row[0][0] != self.cursor_ts
+        if self.cursor <= top and not replaced:
+            return
+        self.db.write_many([
+            ('DELETE FROM heat_tiles', ()),
+            ('DELETE FROM heat_tiles_state', ()),
+        ], timeout=30)
+        self.cursor, self.cursor_ts = 0, None
+        self.rebuilds += 1
+
+    def update(self):
+        """Fold samples past the cursor into their cells; returns how many"""
+        with self._lock:
+            start = time.monotonic()
+            self._ensure_schema()
+            self._check_cursor()
+            rows = self.db.query('''
+                SELECT rowid, lat, lon, risk, active_uplink,
+                       cell_a_rsrp, cell_a_sinr, cell_a_rtt, cell_b_rsrp, cell_b_sinr, cell_b_rtt,
+                       timestamp
+                FROM samples WHERE rowid > ? ORDER BY rowid LIMIT ?
+            ''', (self.cursor, self.chunk))
+            if not rows:
+                return 0
+            cells = {}      # (zoom, uplink, x, y) -> Cell
+            for r in rows:
+                if not r[1] or not r[2]:
+                    continue
+                metrics = sample_metrics(r)
+                for zoom in self.zooms:
+                    x, y = tile_xy(r[1], r[2], zoom)
+                    for uplink, values in metrics.items():
+                        if not values:
+                            continue
+                        key = (zoom, uplink, x, y)
+                        cell = cells.get(key)
+                        if cell is None:
+                            cell = cells[key] = self._load(key)
+                        cell.add(values)
+            now = time.time()
+            last, last_ts = rows[-1][0], rows[-1][11]
+            statements = [(UPSERT, cell.row(*key, now)) for key, cell in cells.items()]
+            statements.append(("INSERT OR REPLACE INTO heat_tiles_state VALUES ('last_rowid', ?)", (last,)))
+            statements.append(("INSERT OR REPLACE INTO heat_tiles_state VALUES ('last_ts', ?)", (last_ts,)))
+            try:
+                self.db.write_many(statements, timeout=30)
+            except:
+                # Committed or not, only heat_tiles_state knows; re-read it next pass
+                self.cursor = None
+                raise
+            self.cursor, self.cursor_ts = last, last_ts
+            self.samples += len(rows)
+            self.passes += 1
+            self.cells_written += len(cells)
+            self.last_pass_ms = round((time.monotonic() - start) * 1000, 1)
+            return len(rows)
+
+    def _load(self, key):
+        rows = self.db.query('SELECT hist FROM heat_tiles WHERE zoom = ? AND uplink = ? AND x = ? AND y = ?', key)
+        return Cell(rows[0][0] if rows else None)
+
+    def run(self):
+        while True:
+            try:
+                # Keep going while a backfill still has full chunks to fold in
+                while self.update() == self.chunk:
+                    pass
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)     # e.g. samples table not created yet
+            time.sleep(self.interval)
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='heattiles', daemon=True)
+                self._thread.start()
+        return self
+
+    def tiles(self, zoom, bbox=None, uplink='active', limit=MAX_TILES):
+        """Cells at the stored level for zoom inside bbox (min_lat, min_lon, max_lat, max_lon)"""
+        zoom = snap_zoom(zoom)
+        query = '''SELECT x, y, n, rsrp_mean, rsrp_p10, sinr_mean, sinr_p10,
+                          rtt_mean, rtt_p10, risk_mean, risk_p10
+                   FROM heat_tiles WHERE zoom = ? AND uplink = ?'''
+        params = [zoom, uplink]
+        if bbox:
+            min_lat, min_lon, max_lat, max_lon = bbox
+            x0, y0 = tile_xy(max_lat, min_lon, zoom)    # y grows southwards
+            x1, y1 = tile_xy(min_lat, max_lon, zoom)
+            query += ' AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?'
+            params += [x0, x1, y0, y1]
+        query += ' ORDER BY n DESC LIMIT ?'
+        params.append(limit)
+        out = []
+        for r in self.db.query(query, params):
+            lat, lon = tile_center(r[0], r[1], zoom)
+            out.append({
+                'lat': round(lat, 6), 'lng': round(lon, 6), 'zoom': zoom,
+                'x': r[0], 'y': r[1], 'quadkey': quadkey(r[0], r[1], zoom),
+                'uplink': uplink, 'samples': r[2],
+                'rsrp': r[3], 'rsrp_p10': r[4], 'sinr': r[5], 'sinr_p10': r[6],
+                'rtt': r[7], 'rtt_p10': r[8], 'risk': r[9] or 0, 'risk_p10': r[10],
+            })
+        return out
+
+    def stats(self):
+        return {'cursor': self.cursor, 'samples': self.samples, 'passes': self.passes,
+                'cells_written': self.cells_written, 'rebuilds': self.rebuilds,
+                'last_pass_ms': self.last_pass_ms,
+                'zooms': list(self.zooms), 'last_error': self.last_error}
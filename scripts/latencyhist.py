@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+PathSteer latency histogram
+
+Log-linear (HDR-style) histogram for durations: values are kept in
+microseconds and bucketed with SUB_BITS bits of precision per power of
+two (~3% relative error at the default 5), so memory is bounded by the
+value range - a few hundred buckets for 1 us..1 h - not by sample count.
+Histograms serialize to plain dicts for JSON persistence and merge by
+adding counts.
+
+    h = LatencyHistogram()
+    h.record(0.182)                  # seconds
+    h.summary()['p99_ms']
+"""
+
+SUB_BITS = 5
+
+
+class LatencyHistogram:
+    __slots__ = ('sub_bits', 'counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self, sub_bits=SUB_BITS):
+        self.sub_bits = sub_bits
+        self.counts = {}        # bucket index -> count
+        self.count = 0
+        self.total = 0          # us
+        self.min = None
+        self.max = 0
+
+    def _index(self, us):
+        shift = us.bit_length() - self.sub_bits
+        if shift <= 0:
+            return us           # small values are exact
+        return (shift << self.sub_bits) + (us >> shift)
+
+    def _value(self, index):
+        """Midpoint (us) of a bucket"""
+        shift = index >> self.sub_bits
+        if not shift:
+            return index
+        low = (index & ((1 << self.sub_bits) - 1)) << shift
+        return low + ((1 << shift) >> 1)
+
+    def record(self, seconds):
+        us = max(0, int(seconds * 1e6))
+        i = self._index(us)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        self.total += us
+        if self.min is None or us < self.min:
+            self.min = us
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, p):
+        """Value at percentile p (0-100) in seconds; None when empty"""
+        if not self.count:
+            return None
+        rank = max(1, round(self.count * p / 100))
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= rank:
+                return min(self._value(i), self.max) / 1e6
+        return self.max / 1e6
+
+    def fraction_below(self, seconds):
+        if not self.count:
+            return None
+        limit = self._index(int(seconds * 1e6))
+        return sum(n for i, n in self.counts.items() if i < limit) / self.count
+
+    def merge(self, other):
+        for i, n in other.counts.items():
+            self.counts[i] = self.counts.get(i, 0) + n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        ms = lambda s: round(s * 1000, 1)
+        return {
+            'count': self.count,
+            'min_ms': ms(self.min / 1e6),
+            'mean_ms': ms(self.total / self.count / 1e6),
+            'p50_ms': ms(self.percentile(50)),
+            'p90_ms': ms(self.percentile(90)),
+            'p99_ms': ms(self.percentile(99)),
+            'max_ms': ms(self.max / 1e6),
+            'under_1s': round(self.fraction_below(1.0), 4),
+        }
+
+    def to_dict(self):
+        return {'sub_bits': self.sub_bits, 'count': self.count, 'total_us': self.total,
+                'min_us': self.min, 'max_us': self.max,
+                'counts': {str(i): n for i, n in self.counts.items()}}
+
+    @classmethod
+    def from_dict(cls, d):
+        h = cls(d.get('sub_bits', SUB_BITS))
+        h.counts = {int(i): n for i, n in d.get('counts', {}).items()}
+        h.count = d.get('count', sum(h.counts.values()))
+        h.total = d.get('total_us', 0)
+        h.min = d.get('min_us')
+        h.max = d.get('max_us', 0)
+        return h
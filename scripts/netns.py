@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+PathSteer network namespace helpers
+
+setns() for the calling thread, and in_netns() to run a function on a
+throwaway helper thread inside a named namespace (/run/netns/<ns>) without
+moving the caller.  Sockets, and /proc/sys/net files, opened there stay
+bound to that namespace, which is how the capture ring, ctnetlink and the
+web UI's netlink readers get per-namespace handles without forking
+`ip netns exec`.
+"""
+import ctypes
+import ctypes.util
+import os
+import socket
+import threading
+
+NETNS_DIR = '/run/netns'
+CLONE_NEWNET = 0x40000000
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+
+def setns(fd, nstype=CLONE_NEWNET):
+    """Move the calling thread into the namespace behind fd"""
+    if _libc.setns(fd, nstype) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def enter_netns(ns):
+    """Move the calling thread into namespace ns by name"""
+    fd = os.open(os.path.join(NETNS_DIR, ns), os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        setns(fd)
+    finally:
+        os.close(fd)
+
+
+def in_netns(ns, fn):
+    """Run fn() on a helper thread inside ns and return its result; the caller stays put.
+
+    ns=None runs fn in our own namespace.  Sockets and /proc/sys/net files
+    opened by fn stay bound to ns.
+    """
+    result = {}
+
+    def run():
+        try:
+            if ns:
+                enter_netns(ns)
+            result['value'] = fn()
+        except BaseException as e:
+            result['error'] = e
+
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    t.join()
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+def socket_in_netns(ns, *args):
+    """Create a socket inside ns"""
+    return in_netns(ns, lambda: socket.socket(*args))
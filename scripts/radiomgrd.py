@@ -10,6 +10,7 @@ import time
 import re
 import logging
 from pathlib import Path
+from trainingdb import shared_db
 
 logging.basicConfig(
     level=logging.INFO,
@@ -181,9 +182,10 @@ def log_radio_event(event_type, old_profile, new_profile, reason=""):
     # Calculate duration since last change
     duration = time.time() - STATE.get("last_profile_change", time.time())
     
+    # Through the shared writer, waiting for the commit: profile changes are
+    # rare, and an insert that fails in the writer thread still gets logged
     try:
-        conn = sqlite3.connect(EVENT_DB)
-        conn.execute("""INSERT INTO radio_events VALUES (
+        shared_db(EVENT_DB).write_wait("""INSERT INTO radio_events VALUES (
             datetime('now'), ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
         )""", (
             lat, lon, event_type, old_profile, new_profile,
@@ -191,8 +193,6 @@ def log_radio_event(event_type, old_profile, new_profile, reason=""):
             tmo.get("band"), tmo.get("rsrp"), tmo.get("sinr"),
             reason, duration
         ))
-        conn.commit()
-        conn.close()
         log.info(f"Event logged: {event_type} - {reason}")
     except Exception as e:
         log.error(f"Event log error: {e}")
@@ -302,38 +302,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
-# Event logging
-import sqlite3
-EVENT_DB = "/opt/pathsteer/data/training.db"
-LAST_PROFILE_CHANGE = None
-LAST_PROFILE = None
-
-def log_radio_event(event_type, old_profile, new_profile, reason=""):
-    global LAST_PROFILE_CHANGE, LAST_PROFILE
-    now = time.time()
-    duration = 0
-    if LAST_PROFILE_CHANGE:
-        duration = now - LAST_PROFILE_CHANGE
-    
-    metrics = STATE["metrics_history"][-1] if STATE["metrics_history"] else {}
-    att = metrics.get("att", {})
-    tmo = metrics.get("tmo", {})
-    
-    try:
-        conn = sqlite3.connect(EVENT_DB)
-        conn.execute("""INSERT INTO radio_events VALUES (
-            datetime('now'), ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
-        )""", (
-            event_type, old_profile, new_profile,
-            att.get("band"), att.get("rsrp"), att.get("sinr"),
-            tmo.get("band"), tmo.get("rsrp"), tmo.get("sinr"),
-            reason, duration
-        ))
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        log.error(f"Event log error: {e}")
-    
-    LAST_PROFILE_CHANGE = now
-    LAST_PROFILE = new_profile
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+PathSteer /run/pathsteer change watcher
+
+Delivers "file replaced" events for the state files the daemons publish
+(status.json, gps.json, flows.json, sip.json, ...) so consumers can react
+within milliseconds instead of polling on a timer.
+
+Uses inotify on the directory (IN_MOVED_TO for the .tmp + rename writers,
+IN_CLOSE_WRITE for pathsteerd's in-place fopen/fclose) and falls back to
+stat polling when inotify is unavailable or the directory does not exist
+yet.
+
+    w = shared_watcher()
+    token = w.token()
+    while True:
+        changed = w.wait(('status.json',), token, timeout=2.0)
+        ...
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+import time
+
+RUN_DIR = '/run/pathsteer'
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+_EVENT = struct.Struct('iIII')
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class RunDirWatcher:
+    """Per-file change counters for one directory, fed by inotify or polling"""
+
+    def __init__(self, path=RUN_DIR, poll_interval=0.5):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._cond = threading.Condition()
+        self._versions = {}
+        self._callbacks = []    # (names or None, fn)
+        self._thread = None
+        self._libc = _load_libc()
+        self.backend = None
+        self.events = 0
+
+    # --- consumer API ---
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return self
+
+    def token(self):
+        """Snapshot of current versions, to pass to wait()"""
+        with self._cond:
+            return dict(self._versions)
+
+    def wait(self, names, token, timeout=None):
+        """Block until any of names changes after token (or timeout).
+
+        Returns the set of changed names and advances token in place, so
+        the same token can be passed straight back in.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                changed = {n for n in names if self._versions.get(n, 0) != token.get(n, 0)}
+                if changed:
+                    for n in changed:
+                        token[n] = self._versions.get(n, 0)
+                    return changed
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return set()
+                self._cond.wait(remaining)
+
+    def on_change(self, names, fn):
+        """Call fn(name) from the watcher thread when one of names changes"""
+        with self._cond:
+            self._callbacks.append((frozenset(names) if names else None, fn))
+
+    def stats(self):
+        with self._cond:
+            return {'path': self.path, 'backend': self.backend, 'events': self.events,
+                    'files': dict(self._versions)}
+
+    # --- watcher thread ---
+    def _changed(self, name):
+        if name.endswith('.tmp'):
+            return
+        with self._cond:
+            callbacks = [fn for names, fn in self._callbacks if names is None or name in names]
+        # Callbacks (cache invalidation) run before waiters wake, so a
+        # woken consumer never sees state from before the change
+        for fn in callbacks:
+            try:
+                fn(name)
+            except Exception:
+                pass
+        with self._cond:
+            self._versions[name] = self._versions.get(name, 0) + 1
+            self.events += 1
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            if self._libc is not None and os.path.isdir(self.path):
+                try:
+                    self._run_inotify()
+                    continue    # directory went away; re-arm
+                except OSError:
+                    # inotify unusable (limits, seccomp): poll from now on
+                    self._libc = None
+            self._run_poll()
+
+    def _run_inotify(self):
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        try:
+            wd = self._libc.inotify_add_watch(fd, self.path.encode(), WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+            self.backend = 'inotify'
+            # Anything may have changed while we were not watching
+            for name in self._listdir():
+                self._changed(name)
+            while True:
+                select.select([fd], [], [])
+                try:
+                    buf = os.read(fd, 64 * 1024)
+                except OSError as e:
+                    if e.errno == errno.EAGAIN:
+                        continue
+                    raise
+                off = 0
+                while off < len(buf):
+                    _, mask, _, length = _EVENT.unpack_from(buf, off)
+                    name = buf[off + _EVENT.size:off + _EVENT.size + length].split(b'\0', 1)[0]
+                    off += _EVENT.size + length
+                    if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                        return
+                    if name:
+                        self._changed(name.decode(errors='replace'))
+        finally:
+            os.close(fd)
+
+    def _listdir(self):
+        try:
+            return [n for n in os.listdir(self.path) if not n.endswith('.tmp')]
+        except OSError:
+            return []
+
+    def _run_poll(self):
+        """stat() every poll_interval; exits once inotify can take over"""
+        self.backend = 'poll'
+        seen = {}
+        while True:
+            current = {}
+            for name in self._listdir():
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                current[name] = (st.st_ino, st.st_mtime_ns, st.st_size)
+            for name, key in current.items():
+                if seen.get(name) != key:
+                    self._changed(name)
+            for name in seen.keys() - current.keys():
+                self._changed(name)
+            seen = current
+            if self._libc is not None and os.path.isdir(self.path):
+                return
+            time.sleep(self.poll_interval)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_watcher():
+    """Process-wide watcher on /run/pathsteer, started on first use"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = RunDirWatcher().start()
+        return _shared
@@ -3,167 +3,337 @@
 PathSteer SIP Monitor
 Sniffs SIP traffic inside ns_vip, parses INVITE/BYE/REGISTER/200OK
 Writes call state to /run/pathsteer/sip.json
+
+Packets come from flow-monitor's capture ring, which forwards SIP-port
+payloads over /run/pathsteer/sip-feed.sock, so SIP is captured once for
+both daemons.  --capture opens a kernel-filtered TPACKET_V3 ring of its
+own instead (only port 5060 copied to userspace), for hosts that do not
+run flow-monitor.
+
+sip.json is published through a debounced writer: updates only mark the
+state dirty, and at most one write happens per WRITE_INTERVAL, except
+call transitions that matter (ringing->active, active->ended), which
+flush at once.
+
+Requests are matched to responses by Call-ID + CSeq to time each
+transaction: post-dial delay (INVITE -> 180/183), call setup time
+(INVITE -> 200), REGISTER round trip and retransmissions, aggregated into
+latency histograms keyed by the active_uplink at the time of the request.
 """
-import subprocess
-import re
+import argparse
 import json
 import time
 import os
 import threading
+from pktcapture import PacketRing
+from sipparse import FEED_PATH, SipStreams, feed_packets
+from sipstore import SipStore, registration_ttl
+from latencyhist import LatencyHistogram
+from runwatch import shared_watcher
 
 SIP_FILE = '/run/pathsteer/sip.json'
-calls = {}  # call-id -> call info
-registrations = {}  # user -> registration info
+TIMING_FILE = '/run/pathsteer/sip-timing.json'
+STATUS_FILE = '/run/pathsteer/status.json'
+WRITE_INTERVAL = float(os.environ.get('SIP_WRITE_INTERVAL', '0.25'))
+HEARTBEAT = 5       # rewrite even when idle so 'updated' stays fresh
+CALL_CAPACITY = 2000
+REG_CAPACITY = 5000
+RINGING_TTL = 300
+ENDED_TTL = 60
+calls = SipStore(CALL_CAPACITY)  # call-id -> call info, LRU by last update
+registrations = SipStore(REG_CAPACITY)  # user -> registration info, expires per REGISTER
 lock = threading.Lock()
 
+# Open transactions, (call_id, cseq, method) -> timing state; 64*T1 lifetime
+TXN_CAPACITY = 4096
+TXN_TTL = 32
+# A repeat closer than this is the same packet captured twice (e.g. on both
+# sides of ns_vip's forwarding hop); real retransmits wait at least T1 (500 ms)
+COPY_WINDOW = 0.05
+transactions = SipStore(TXN_CAPACITY)
+# Per-uplink transaction timing: pdd, setup, register_rtt histograms + retransmissions
+timing = {}
+active_uplink = None
+
+class Publisher:
+    """Coalesces state changes into at most one write() per interval"""
+
+    def __init__(self, write, interval=WRITE_INTERVAL, heartbeat=HEARTBEAT):
+        self.write = write
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self._cond = threading.Condition()
+        self._dirty = False
+        self._urgent = False
+        self.updates = 0
+        self.writes = 0
+        self.urgent_writes = 0
+        self.heartbeats = 0
+
+    def mark(self, urgent=False):
+        with self._cond:
+            self.updates += 1
+            if urgent:
+                self._urgent = True
+            # Already dirty: the publisher is waiting out the interval anyway
+            if urgent or not self._dirty:
+                self._cond.notify()
+            self._dirty = True
+
+    def run(self):
+        last = 0
+        while True:
+            with self._cond:
+                kind = None
+                while kind is None:
+                    if self._urgent:
+                        kind = 'urgent'
+                    elif self._dirty:
+                        remaining = last + self.interval - time.monotonic()
+                        if remaining <= 0:
+                            kind = 'write'
+                        else:
+                            self._cond.wait(remaining)
+                    elif not self._cond.wait(self.heartbeat):
+                        kind = 'heartbeat'
+                self._dirty = self._urgent = False
+                self.writes += 1
+                if kind == 'urgent':
+                    self.urgent_writes += 1
+                elif kind == 'heartbeat':
+                    self.heartbeats += 1
+            self.write()
+            last = time.monotonic()
+
+    def stats(self):
+        with self._cond:
+            changed = self.writes - self.heartbeats
+            return {
+                'updates': self.updates,
+                'writes': self.writes,
+                'urgent_writes': self.urgent_writes,
+                'heartbeats': self.heartbeats,
+                'interval_ms': round(self.interval * 1000),
+                'coalescing_ratio': round(self.updates / changed, 2) if changed else None,
+            }
+
+def _timing(uplink):
+    t = timing.get(uplink)
+    if t is None:
+        t = timing[uplink] = {'transactions': 0, 'pdd': LatencyHistogram(), 'setup': LatencyHistogram(),
+                              'register_rtt': LatencyHistogram(), 'retransmissions': {},
+                              'response_retransmissions': 0}
+    return t
+
+def track_transaction(msg, ts):
+    """Match a message to its transaction by Call-ID + CSeq; caller holds lock.
+
+    Returns the transaction dict (start, uplink, retrans, provisional,
+    final - the latter two as seconds since the request) or None.  Repeats
+    within COPY_WINDOW of the last request or final response are captured
+    copies, not retransmissions.
+    """
+    if msg.cseq is None or msg.method == 'ACK':
+        return None
+    method = msg.method or msg.cseq_method
+    key = (msg.call_id, msg.cseq, method)
+    txn = transactions.get(key)
+    if msg.method:
+        if txn is None:
+            uplink = active_uplink or 'unknown'
+            txn = transactions.put(key, {'start': ts, 'uplink': uplink, 'retrans': 0,
+                                         'provisional': None, 'final': None,
+                                         'sent': ts, 'answered': None}, ts, ttl=TXN_TTL)
+            _timing(uplink)['transactions'] += 1
+        elif ts - txn['sent'] >= COPY_WINDOW:
+            txn['sent'] = ts
+            txn['retrans'] += 1
+            r = _timing(txn['uplink'])['retransmissions']
+            r[method] = r.get(method, 0) + 1
+        return txn
+    if txn is None:
+        return None
+    t = _timing(txn['uplink'])
+    dt = ts - txn['start']
+    if msg.status < 200:
+        if method == 'INVITE' and msg.status in (180, 183) and txn['provisional'] is None:
+            txn['provisional'] = dt
+            t['pdd'].record(dt)
+    elif txn['final'] is not None:
+        if ts - txn['answered'] >= COPY_WINDOW:
+            txn['answered'] = ts
+            t['response_retransmissions'] += 1
+    else:
+        txn['final'] = dt
+        txn['answered'] = ts
+        if method == 'INVITE' and msg.status < 300:
+            t['setup'].record(dt)
+        elif method == 'REGISTER':
+            t['register_rtt'].record(dt)
+    return txn
+
+def timing_summary():
+    """caller holds lock"""
+    return {uplink: {
+        'transactions': t['transactions'],
+        'post_dial_delay': t['pdd'].summary(),
+        'setup_time': t['setup'].summary(),
+        'register_rtt': t['register_rtt'].summary(),
+        'retransmissions': dict(t['retransmissions']),
+        'response_retransmissions': t['response_retransmissions'],
+    } for uplink, t in timing.items()}
+
 def write_state():
     with lock:
+        summary = timing_summary()
         state = {
             'active_calls': len([c for c in calls.values() if c['state'] == 'active']),
             'total_calls': len(calls),
             'registrations': len(registrations),
-            'calls': list(calls.values())[-10:],  # last 10
-            'regs': list(registrations.values())[-5:],
+            'calls': calls.recent(10),  # last 10 updated
+            'regs': registrations.recent(5),
+            'store': {'calls': calls.stats(), 'regs': registrations.stats()},
+            'active_uplink': active_uplink,
+            'timing': summary,
+            'publisher': publisher.stats(),
             'updated': time.time()
         }
     try:
         with open(SIP_FILE + '.tmp', 'w') as f:
             json.dump(state, f)
         os.rename(SIP_FILE + '.tmp', SIP_FILE)
+        # Separate copy for /api/sip/timing: flow-monitor also writes sip.json
+        with open(TIMING_FILE + '.tmp', 'w') as f:
+            json.dump({'active_uplink': state['active_uplink'], 'timing': summary,
+                       'updated': state['updated']}, f)
+        os.rename(TIMING_FILE + '.tmp', TIMING_FILE)
     except:
         pass
 
-def parse_sip(packet_lines):
-    """Parse a SIP message from tcpdump output"""
-    text = '\n'.join(packet_lines)
-    
-    # Extract method
-    method = None
-    m = re.search(r'^(INVITE|BYE|REGISTER|ACK|CANCEL|OPTIONS|INFO|UPDATE|REFER) ', text, re.M)
-    if m:
-        method = m.group(1)
-    
-    # Check for response
-    status = None
-    m = re.search(r'^SIP/2\.0 (\d{3})', text, re.M)
-    if m:
-        status = int(m.group(1))
-    
-    # Call-ID
-    call_id = None
-    m = re.search(r'Call-ID:\s*(.+)', text, re.I)
-    if m:
-        call_id = m.group(1).strip()
-    
-    # From
-    from_uri = None
-    m = re.search(r'From:\s*<?sip:([^>;@]+)@?([^>;]*)', text, re.I)
-    if m:
-        from_uri = m.group(1)
-    
-    # To
-    to_uri = None
-    m = re.search(r'To:\s*<?sip:([^>;@]+)@?([^>;]*)', text, re.I)
-    if m:
-        to_uri = m.group(1)
-    
-    # Contact (for REGISTER)
-    contact = None
-    m = re.search(r'Contact:\s*<?sip:([^>;]+)', text, re.I)
-    if m:
-        contact = m.group(1)
-    
-    return method, status, call_id, from_uri, to_uri, contact
+SIP_PORTS = (5060,)
 
-def process_sip(method, status, call_id, from_uri, to_uri, contact):
+def process_sip(msg, ts=None):
+    call_id, method, status = msg.call_id, msg.method, msg.status
+    from_uri, to_uri, contact = msg.from_user, msg.to_user, msg.contact
     if not call_id:
         return
     
+    urgent = False
     with lock:
         now = time.time()
+        txn = track_transaction(msg, ts or now)
         
         if method == 'INVITE':
-            calls[call_id] = {
+            calls.put(call_id, {
                 'call_id': call_id[:30],
                 'calling': from_uri or '?',
                 'called': to_uri or '?',
                 'state': 'ringing',
                 'start': now,
-                'updated': now
-            }
+            }, now, ttl=RINGING_TTL)
         elif method == 'BYE':
             if call_id in calls:
-                calls[call_id]['state'] = 'ended'
-                calls[call_id]['updated'] = now
+                urgent = calls.get(call_id)['state'] == 'active'
+                calls.touch(call_id, now, ttl=ENDED_TTL)['state'] = 'ended'
         elif method == 'CANCEL':
             if call_id in calls:
-                calls[call_id]['state'] = 'cancelled'
-                calls[call_id]['updated'] = now
+                calls.touch(call_id, now, ttl=ENDED_TTL)['state'] = 'cancelled'
         elif method == 'REGISTER':
             if from_uri:
-                registrations[from_uri] = {
-                    'user': from_uri,
-                    'contact': contact or '?',
-                    'updated': now
-                }
-        
+                ttl = registration_ttl(msg)
+                if ttl:
+                    registrations.put(from_uri, {
+                        'user': from_uri,
+                        'contact': contact or '?',
+                        'expires': ttl,
+                    }, now, ttl=ttl)
+                else:
+                    registrations.pop(from_uri)
+
+        if txn is not None and status and msg.cseq_method == 'INVITE' and call_id in calls:
+            call = calls.get(call_id)
+            if txn['provisional'] is not None and 'pdd_ms' not in call:
+                call['pdd_ms'] = round(txn['provisional'] * 1000, 1)
+            if 200 <= status < 300 and txn['final'] is not None and 'setup_ms' not in call:
+                call['setup_ms'] = round(txn['final'] * 1000, 1)
+                call['retransmissions'] = txn['retrans']
+
         # 200 OK to INVITE = call active
-        if status == 200 and call_id in calls and calls[call_id]['state'] == 'ringing':
-            calls[call_id]['state'] = 'active'
-            calls[call_id]['updated'] = now
-    
-    write_state()
+        if status == 200 and call_id in calls and calls.get(call_id)['state'] == 'ringing':
+            calls.touch(call_id, now, ttl=None)['state'] = 'active'
+            urgent = True
+        # 200 OK to REGISTER carries the lifetime the registrar granted
+        elif status == 200 and msg.cseq_method == 'REGISTER' and from_uri in registrations \
+                and msg.expires is not None:
+            if msg.expires:
+                registrations.touch(from_uri, now, ttl=msg.expires)['expires'] = msg.expires
+            else:
+                registrations.pop(from_uri)
+
+    publisher.mark(urgent)
 
 def run_capture():
-    """Run tcpdump inside ns_vip capturing SIP"""
-    cmd = [
-        'ip', 'netns', 'exec', 'ns_vip',
-        'tcpdump', '-i', 'any', '-l', '-A',
-        '-s', '0', 'udp port 5060 or tcp port 5060',
-    ]
-    
+    """Read SIP packets inside ns_vip from a kernel-filtered ring (standalone mode)"""
+    ring = PacketRing('ns_vip', payload_ports=SIP_PORTS, filter_ports=SIP_PORTS, block_size=1 << 18)
+    streams = SipStreams()
     print("SIP Monitor starting capture in ns_vip...")
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    
-    sip_buffer = []
-    in_sip = False
-    
-    for line in proc.stdout:
-        line = line.rstrip()
-        
-        # Start of SIP message
-        if any(m in line for m in ['INVITE sip:', 'BYE sip:', 'REGISTER sip:', 'SIP/2.0 ', 'ACK sip:', 'CANCEL sip:']):
-            if sip_buffer:
-                method, status, call_id, from_uri, to_uri, contact = parse_sip(sip_buffer)
-                if method or status:
-                    process_sip(method, status, call_id, from_uri, to_uri, contact)
-            sip_buffer = [line]
-            in_sip = True
-        elif in_sip:
-            if line == '' or line.startswith('    '):
-                if sip_buffer:
-                    method, status, call_id, from_uri, to_uri, contact = parse_sip(sip_buffer)
-                    if method or status:
-                        process_sip(method, status, call_id, from_uri, to_uri, contact)
-                    sip_buffer = []
-                    in_sip = False
-            else:
-                sip_buffer.append(line)
+    for batch in ring.batches():
+        for pkt in batch:
+            if pkt[6]:
+                for msg in streams.decode(pkt):
+                    process_sip(msg, pkt[7])
 
-# Periodic state writer (even if no SIP traffic)
+def run_feed():
+    """Read SIP packets forwarded by flow-monitor's capture ring"""
+    streams = SipStreams()
+    print(f"SIP Monitor reading flow-monitor's SIP feed on {FEED_PATH}...")
+    for pkt in feed_packets():
+        for msg in streams.decode(pkt):
+            process_sip(msg, pkt[7])
+
+publisher = Publisher(write_state)
+
+def uplink_watcher():
+    """Follow active_uplink in status.json so timings land in the right bucket"""
+    global active_uplink
+    watch = shared_watcher()
+    token = watch.token()
+    while True:
+        try:
+            with open(STATUS_FILE, 'r') as f:
+                uplink = json.load(f).get('active_uplink')
+            if uplink and uplink != active_uplink:
+                active_uplink = uplink
+                publisher.mark()
+        except:
+            pass
+        watch.wait(('status.json',), token, timeout=2)
+
+# Periodic cleanup; the publisher's heartbeat keeps sip.json fresh when idle
 def periodic_writer():
     while True:
-        write_state()
-        # Clean up old ended calls (>60s)
+        # Drop ended calls past ENDED_TTL, stale ringing calls and lapsed registrations
         with lock:
-            old = [k for k, v in calls.items() if v['state'] in ('ended', 'cancelled') and time.time() - v['updated'] > 60]
-            for k in old:
-                del calls[k]
+            now = time.time()
+            old = calls.expire(now) + registrations.expire(now)
+            transactions.expire(now)
+        if old:
+            publisher.mark()
         time.sleep(5)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PathSteer SIP monitor')
+    parser.add_argument('--capture', action='store_true',
+                        help="capture SIP in ns_vip directly instead of reading flow-monitor's feed")
+    args = parser.parse_args()
+
     os.makedirs('/run/pathsteer', exist_ok=True)
     write_state()
+    threading.Thread(target=publisher.run, daemon=True).start()
+    threading.Thread(target=uplink_watcher, daemon=True).start()
     t = threading.Thread(target=periodic_writer, daemon=True)
     t.start()
-    run_capture()
+    if args.capture:
+        run_capture()
+    else:
+        run_feed()
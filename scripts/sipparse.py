@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+PathSteer SIP message parser
+
+Parses SIP straight from UDP/TCP payload bytes:
+  - messages are framed by the header terminator and Content-Length, so
+    one datagram or TCP segment may carry several messages and a TCP
+    message may span segments (SipStreams keeps per-connection buffers)
+  - headers are scanned once, line by line, with compact forms
+    (i: f: t: m: l: c: v:) folded onto their long names
+  - Call-ID, From/To user and tag, CSeq, Contact, Expires and the SDP
+    connection address and media ports come out of that single pass
+
+    streams = SipStreams()
+    for pkt in batch:                       # PacketRing tuples with payloads
+        for msg in streams.decode(pkt):
+            msg.method or msg.status, msg.call_id, msg.cseq, msg.media, ...
+
+SipFeed/feed_packets() pass those SIP-port tuples from flow-monitor's
+capture ring to sip-monitor over a Unix datagram socket, so SIP is
+captured once however many consumers parse it.
+"""
+import errno
+import os
+import socket
+import struct
+from collections import OrderedDict
+
+COMPACT = {
+    b'i': b'call-id', b'f': b'from', b't': b'to', b'm': b'contact',
+    b'l': b'content-length', b'c': b'content-type', b'v': b'via',
+    b'e': b'content-encoding', b'k': b'supported', b's': b'subject',
+}
+METHODS = frozenset((b'INVITE', b'ACK', b'BYE', b'CANCEL', b'REGISTER', b'OPTIONS', b'INFO',
+                     b'UPDATE', b'REFER', b'PRACK', b'SUBSCRIBE', b'NOTIFY', b'MESSAGE', b'PUBLISH'))
+MAX_HEADER = 16384
+MAX_BODY = 65536
+
+
+class SipMessage:
+    __slots__ = ('method', 'status', 'reason', 'uri', 'call_id', 'from_user', 'from_tag',
+                 'to_user', 'to_tag', 'cseq', 'cseq_method', 'contact', 'expires',
+                 'content_type', 'body', 'media')
+
+    def __init__(self):
+        self.method = None          # request method (str) or None for responses
+        self.status = None          # response code (int) or None for requests
+        self.reason = None
+        self.uri = None
+        self.call_id = None
+        self.from_user = None
+        self.from_tag = None
+        self.to_user = None
+        self.to_tag = None
+        self.cseq = None
+        self.cseq_method = None
+        self.contact = None
+        self.expires = None
+        self.content_type = None
+        self.body = b''
+        self.media = []             # [(kind, addr, port, proto)] from SDP
+
+    @property
+    def is_request(self):
+        return self.method is not None
+
+
+def _uri_user(value):
+    """User part of the first sip:/sips:/tel: URI in a header value, plus its ;tag="""
+    user = None
+    for scheme in (b'sip:', b'sips:', b'tel:'):
+        i = value.find(scheme)
+        if i >= 0:
+            start = i + len(scheme)
+            end = start
+            n = len(value)
+            while end < n and value[end] not in b'@>;: \t':
+                end += 1
+            user = value[start:end].decode('utf-8', 'replace')
+            break
+    tag = None
+    i = value.find(b';tag=')
+    if i >= 0:
+        end = i + 5
+        while end < len(value) and value[end] not in b';,> \t':
+            end += 1
+        tag = value[i + 5:end].decode('ascii', 'replace')
+    return user, tag
+
+
+def _contact(value):
+    """sip URI body (user@host[:port]) of a Contact value"""
+    for scheme in (b'sip:', b'sips:'):
+        i = value.find(scheme)
+        if i >= 0:
+            start = i + len(scheme)
+            end = start
+            while end < len(value) and value[end] not in b'>; \t':
+                end += 1
+            return value[start:end].decode('utf-8', 'replace')
+    return None
+
+
+def parse_sdp(body):
+    """[(kind, addr, port, proto)] for each m= line; media-level c= overrides session c="""
+    media = []
+    session_addr = None
+    current = None
+    for line in body.split(b'\n'):
+        line = line.rstrip(b'\r')
+        if len(line) < 2 or line[1:2] != b'=':
+            continue
+        kind = line[:1]
+        if kind == b'c':
+            # c=IN IP4 203.0.113.5[/ttl]
+            parts = line[2:].split()
+            addr = parts[2].split(b'/')[0].decode('ascii', 'replace') if len(parts) >= 3 else None
+            if current is None:
+                session_addr = addr
+            else:
+                current[1] = addr
+        elif kind == b'm':
+            # m=audio 49170 RTP/AVP 0 8
+            parts = line[2:].split()
+            if len(parts) >= 3 and parts[1].split(b'/')[0].isdigit():
+                current = [parts[0].decode('ascii', 'replace'), session_addr,
+                           int(parts[1].split(b'/')[0]), parts[2].decode('ascii', 'replace')]
+                media.append(current)
+    return [tuple(m) for m in media]
+
+
+def parse_message(buf, start=0, datagram=False):
+    """Parse one message at buf[start:].
+
+    Returns (msg, end) with end the offset just past it, (None, start) if
+    the message is incomplete, or (None, -1) if buf[start:] is not SIP.
+    Content-Length is optional over UDP: a datagram without it runs to the end.
+    """
+    hdr_end = buf.find(b'\r\n\r\n', start)
+    sep = 4
+    if hdr_end < 0:
+        hdr_end = buf.find(b'\n\n', start)
+        sep = 2
+    if hdr_end < 0:
+        return (None, -1) if len(buf) - start > MAX_HEADER else (None, start)
+    lines = bytes(buf[start:hdr_end]).split(b'\n')
+    first = lines[0].rstrip(b'\r')
+    msg = SipMessage()
+    if first.startswith(b'SIP/2.0 '):
+        parts = first.split(b' ', 2)
+        if len(parts) < 2 or not parts[1].isdigit():
+            return None, -1
+        msg.status = int(parts[1])
+        msg.reason = parts[2].decode('utf-8', 'replace') if len(parts) > 2 else ''
+    else:
+        parts = first.split(b' ')
+        if len(parts) != 3 or parts[0] not in METHODS or not parts[2].startswith(b'SIP/'):
+            return None, -1
+        msg.method = parts[0].decode('ascii')
+        msg.uri = parts[1].decode('utf-8', 'replace')
+
+    length = None
+    header_expires = None
+    headers = []
+    for line in lines[1:]:
+        line = line.rstrip(b'\r')
+        if line[:1] in (b' ', b'\t') and headers:
+            headers[-1][1] += b' ' + line.strip()       # folded continuation
+            continue
+        colon = line.find(b':')
+        if colon <= 0:
+            continue
+        name = line[:colon].strip().lower()
+        headers.append([COMPACT.get(name, name), line[colon + 1:].strip()])
+    for name, value in headers:
+        if name == b'call-id':
+            msg.call_id = value.decode('utf-8', 'replace')
+        elif name == b'from':
+            msg.from_user, msg.from_tag = _uri_user(value)
+        elif name == b'to':
+            msg.to_user, msg.to_tag = _uri_user(value)
+        elif name == b'cseq':
+            parts = value.split()
+            if parts and parts[0].isdigit():
+                msg.cseq = int(parts[0])
+                msg.cseq_method = parts[1].decode('ascii', 'replace') if len(parts) > 1 else None
+        elif name == b'content-length':
+            length = int(value) if value.isdigit() else 0
+        elif name == b'content-type':
+            msg.content_type = value.split(b';')[0].strip().lower().decode('ascii', 'replace')
+        elif name == b'contact':
+            if msg.contact is None:
+                msg.contact = _contact(value)
+            i = value.find(b'expires=')
+            if i >= 0 and msg.expires is None:
+                digits = value[i + 8:].split(b';')[0].split(b',')[0].strip()
+                if digits.isdigit():
+                    msg.expires = int(digits)
+        elif name == b'expires':
+            if value.isdigit():
+                header_expires = int(value)
+    if msg.expires is None:
+        msg.expires = header_expires     # a Contact expires= param wins
+
+    body_start = hdr_end + sep
+    if length is None:
+        length = len(buf) - body_start if datagram else 0
+    if length > MAX_BODY:
+        return None, -1
+    if len(buf) < body_start + length:
+        return None, start
+    msg.body = bytes(buf[body_start:body_start + length])
+    if msg.body and msg.content_type == 'application/sdp':
+        msg.media = parse_sdp(msg.body)
+    return msg, body_start + length
+
+
+def _resync(buf, start):
+    """Offset of the next plausible start line after start, or -1"""
+    best = -1
+    for marker in (b'\nSIP/2.0 ',) + tuple(b'\n' + m + b' ' for m in METHODS):
+        i = buf.find(marker, start)
+        if i >= 0 and (best < 0 or i + 1 < best):
+            best = i + 1
+    return best
+
+
+def parse_datagram(payload):
+    """All complete messages in one UDP payload (keepalive CRLFs are skipped)"""
+    out = []
+    pos = 0
+    n = len(payload)
+    while pos < n:
+        while pos < n and payload[pos] in b'\r\n':
+            pos += 1
+        if pos >= n:
+            break
+        msg, end = parse_message(payload, pos, datagram=True)
+        if msg is None:
+            break
+        out.append(msg)
+        pos = end
+    return out
+
+
+class SipStreams:
+    """Per-connection reassembly buffers for SIP over TCP.
+
+    Segments are assumed in order (the capture has no sequence tracking);
+    a buffer that stops looking like SIP is resynced at the next start line.
+    """
+
+    def __init__(self, max_streams=1024, max_buffer=MAX_HEADER + MAX_BODY):
+        self.max_streams = max_streams
+        self.max_buffer = max_buffer
+        self._buffers = OrderedDict()
+        self.dropped = 0
+
+    def feed(self, key, payload):
+        """Append a segment for connection key; return completed messages"""
+        buf = self._buffers.pop(key, None)
+        if buf is None:
+            buf = bytearray()
+        buf += payload
+        out = []
+        pos = 0
+        while pos < len(buf):
+            while pos < len(buf) and buf[pos] in b'\r\n':
+                pos += 1
+            msg, end = parse_message(buf, pos)
+            if msg is not None:
+                out.append(msg)
+                pos = end
+            elif end == pos:
+                break               # incomplete: wait for more
+            else:
+                nxt = _resync(buf, pos)
+                if nxt < 0:
+                    self.dropped += 1
+                    pos = len(buf)
+                else:
+                    pos = nxt
+        del buf[:pos]
+        if len(buf) > self.max_buffer:
+            self.dropped += 1
+            buf = bytearray()
+        if buf:
+            self._buffers[key] = buf
+            if len(self._buffers) > self.max_streams:
+                self._buffers.popitem(last=False)
+        return out
+
+    def decode(self, pkt):
+        """Messages in one PacketRing tuple (UDP: the datagram, TCP: via the stream buffer)"""
+        if pkt[0] == 'udp':
+            return parse_datagram(pkt[6])
+        return self.feed((pkt[1], pkt[2], pkt[3], pkt[4]), pkt[6])
+
+
+# === Capture feed: flow-monitor -> sip-monitor ===
+
+FEED_PATH = '/run/pathsteer/sip-feed.sock'
+_FEED = struct.Struct('!BIHIHHd')   # proto, src, sport, dst, dport, IP length, kernel ts
+_PROTO = {'tcp': 6, 'udp': 17}
+_PROTO_NAME = {6: 'tcp', 17: 'udp'}
+
+
+class SipFeed:
+    """Non-blocking sender of SIP-port PacketRing tuples to FEED_PATH.
+
+    Nobody listening (sip-monitor not running) or a full socket buffer
+    drops the packet rather than stalling the capture thread.
+    """
+
+    def __init__(self, path=FEED_PATH):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC)
+        self.sent = 0
+        self.dropped = 0
+
+    def send(self, pkt):
+        try:
+            self.sock.sendto(_FEED.pack(_PROTO[pkt[0]], pkt[1], pkt[2], pkt[3], pkt[4], min(pkt[5], 0xffff), pkt[7]) + pkt[6],
+                             self.path)
+            self.sent += 1
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ECONNREFUSED, errno.EAGAIN, errno.ENOBUFS, errno.EMSGSIZE):
+                raise
+            self.dropped += 1
+
+    def stats(self):
+        return {'path': self.path, 'sent': self.sent, 'dropped': self.dropped}
+
+
+def feed_packets(path=FEED_PATH):
+    """Bind FEED_PATH and yield PacketRing-shaped tuples sent by SipFeed"""
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC)
+    sock.bind(path)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 21)
+    while True:
+        data = sock.recv(MAX_HEADER + MAX_BODY + _FEED.size)
+        if len(data) < _FEED.size:
+            continue
+        proto, src, sport, dst, dport, length, ts = _FEED.unpack_from(data)
+        yield (_PROTO_NAME.get(proto, 'udp'), src, sport, dst, dport, length, data[_FEED.size:], ts)
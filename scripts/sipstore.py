@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+PathSteer bounded SIP state store
+
+Call and registration tables for the SIP monitors.  Entries are dicts
+(written to sip.json as-is) held in an OrderedDict kept in update order,
+which doubles as the LRU list: touching an entry moves it to the tail,
+"last N updated" walks back from the tail, and when the store is full the
+head (least recently updated) is evicted.  Entries may carry a deadline
+(ended-call retention, registration Expires); deadlines sit in a min-heap
+so expiry only looks at the entries that are actually due.
+
+    calls = SipStore(capacity=2000)
+    calls.put(call_id, {...}, now, ttl=300)
+    calls.touch(call_id, now, ttl=120)
+    for key, entry in calls.expire(now): ...
+    calls.recent(10)
+"""
+import heapq
+from collections import OrderedDict
+from itertools import islice
+
+DEFAULT_EXPIRES = 3600      # RFC 3261 default registration lifetime
+
+
+def registration_ttl(msg):
+    """Seconds a REGISTER (or its 200 OK) keeps the binding; 0 means unregister"""
+    return DEFAULT_EXPIRES if msg.expires is None else msg.expires
+
+
+class SipStore:
+    def __init__(self, capacity=2000, on_evict=None):
+        self.capacity = capacity
+        self.on_evict = on_evict
+        self._items = OrderedDict()
+        self._deadline = {}     # key -> expiry time
+        self._heap = []         # (expiry, seq, key); stale entries skipped lazily
+        self._seq = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        return self._items.get(key, default)
+
+    def values(self):
+        return self._items.values()
+
+    def items(self):
+        return self._items.items()
+
+    def _set_deadline(self, key, deadline):
+        if deadline is None:
+            self._deadline.pop(key, None)
+            return
+        self._deadline[key] = deadline
+        self._seq += 1
+        heapq.heappush(self._heap, (deadline, self._seq, key))
+        if len(self._heap) > 2 * len(self._deadline) + 64:
+            self._heap = [(d, i, k) for i, (k, d) in enumerate(self._deadline.items())]
+            heapq.heapify(self._heap)
+
+    def put(self, key, entry, now, ttl=None):
+        """Insert or replace key as the most recently updated entry"""
+        entry['updated'] = now
+        self._items.pop(key, None)
+        self._items[key] = entry
+        self._set_deadline(key, None if ttl is None else now + ttl)
+        while len(self._items) > self.capacity:
+            old, old_entry = self._items.popitem(last=False)
+            self._deadline.pop(old, None)
+            self.evicted += 1
+            if self.on_evict is not None:
+                self.on_evict(old, old_entry)
+        return entry
+
+    def touch(self, key, now, ttl=False):
+        """Mark key updated; ttl=None clears its deadline, False leaves it alone"""
+        entry = self._items.get(key)
+        if entry is None:
+            return None
+        entry['updated'] = now
+        self._items.move_to_end(key)
+        if ttl is not False:
+            self._set_deadline(key, None if ttl is None else now + ttl)
+        return entry
+
+    def pop(self, key):
+        self._deadline.pop(key, None)
+        return self._items.pop(key, None)
+
+    def expire(self, now):
+        """Remove and return [(key, entry)] whose deadline has passed"""
+        out = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(heap)
+            if self._deadline.get(key) != deadline:
+                continue        # rescheduled or removed since
+            del self._deadline[key]
+            out.append((key, self._items.pop(key)))
+        self.expired += len(out)
+        return out
+
+    def recent(self, n):
+        """The n most recently updated entries, newest first"""
+        return list(islice(reversed(self._items.values()), n))
+
+    def recent_items(self, n):
+        return list(islice(reversed(self._items.items()), n))
+
+    def stats(self):
+        return {'size': len(self._items), 'capacity': self.capacity,
+                'evicted': self.evicted, 'expired': self.expired}
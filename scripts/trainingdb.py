@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+PathSteer training.db access layer
+
+One process-wide handle per database file:
+  - writes go through a queue to a single long-lived writer thread, which
+    drains whatever has piled up (up to MAX_BATCH statements, lingering
+    MAX_DELAY for stragglers) and runs it as one transaction, so a burst
+    of inserts pays for one commit instead of one each
+  - the file is switched to WAL with synchronous=NORMAL: readers no longer
+    block the writer (or pathsteerd and training-collect.sh) and commits
+    skip the per-transaction fsync of the rollback journal
+  - queries borrow a read-only connection from a small pool instead of
+    opening and closing the file per request
+Queue depth, batch sizes and commit latency are kept for stats().
+
+    db = shared_db('/opt/pathsteer/data/training.db')
+    db.write('INSERT INTO events (...) VALUES (?, ?)', (a, b))      # fire and forget
+    db.write_wait('INSERT ...', params)                              # raises on error
+    db.write_many([(sql, params), ...])                              # atomic group
+    rows = db.query('SELECT ... WHERE x = ?', (x,))
+"""
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from latencyhist import LatencyHistogram
+
+DB_PATH = '/opt/pathsteer/data/training.db'
+
+MAX_BATCH = 256         # statements per transaction
+MAX_DELAY = 0.02        # linger for more writes once the first one arrives
+MAX_QUEUE = 10000       # beyond this write() drops instead of growing memory
+READERS = 4             # pooled read-only connections kept open
+BUSY_TIMEOUT_MS = 5000
+SYNCHRONOUS = 'NORMAL'  # WAL + NORMAL: durable across app crashes, may lose the last commit on power loss
+
+
+class TrainingDB:
+    def __init__(self, path=DB_PATH, readers=READERS, max_batch=MAX_BATCH, max_delay=MAX_DELAY,
+                 max_queue=MAX_QUEUE, synchronous=SYNCHRONOUS):
+        self.path = path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.synchronous = synchronous
+        self._queue = queue.Queue(max_queue)
+        self._pool = queue.LifoQueue(readers)
+        self._writer = None
+        self._conn = None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._inflight = 0
+        # Metrics
+        self.commit_latency = LatencyHistogram()
+        self.query_latency = LatencyHistogram()
+        self.max_depth = 0
+        self.batches = 0
+        self.rows = 0
+        self.dropped = 0
+        self.write_errors = 0
+        self.commit_errors = 0
+        self.queries = 0
+        self.query_errors = 0
+        self.readers_opened = 0
+        self.last_error = None
+
+    # === Writes ===
+
+    def _start(self):
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._run, name='trainingdb-writer', daemon=True)
+            self._writer.start()
+
+    def _enqueue(self, item):
+        with self._lock:
+            self._start()
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+                return False
+            self._inflight += 1
+            depth = self._queue.qsize()
+            if depth > self.max_depth:
+                self.max_depth = depth
+        return True
+
+    def write(self, sql, params=()):
+        """Queue a statement; returns False if the queue was full and it was dropped"""
+        return self._enqueue((sql, params, None))
+
+    def write_wait(self, sql, params=(), timeout=5.0):
+        """Queue a statement and wait for its commit; returns lastrowid, raises on error"""
+        fut = Future()
+        if not self._enqueue((sql, params, fut)):
+            raise sqlite3.OperationalError('write queue full')
+        return fut.result(timeout)
+
+    def write_many(self, statements, timeout=5.0):
+        """Queue [(sql, params)] to run all-or-nothing inside the next batch and wait for it"""
+        fut = Future()
+        if not self._enqueue((list(statements), None, fut)):
+            raise sqlite3.OperationalError('write queue full')
+        return fut.result(timeout)
+
+    def flush(self, timeout=5.0):
+        """Wait until everything queued so far is committed (or failed)"""
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self._inflight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def _connect_writer(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        return conn
+
+    def _collect(self):
+        """Block for one item, then take what else arrives within max_delay"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run_group(self, conn, statements):
+        """write_many(): a savepoint so a failure undoes only this group"""
+        conn.execute('SAVEPOINT grp')
+        try:
+            for sql, params in statements:
+                conn.execute(sql, params)
+        except:
+            conn.execute('ROLLBACK TO grp')
+            conn.execute('RELEASE grp')
+            raise
+        conn.execute('RELEASE grp')
+        return len(statements)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            results = []
+            try:
+                if self._conn is None:
+                    self._conn = self._connect_writer()
+                conn = self._conn
+                start = time.monotonic()
+                conn.execute('BEGIN IMMEDIATE')
+                for sql, params, fut in batch:
+                    # A bad statement fails alone; the rest of the batch still commits
+                    try:
+                        if isinstance(sql, list):
+                            results.append((fut, self._run_group(conn, sql), None))
+                        else:
+                            results.append((fut, conn.execute(sql, params).lastrowid, None))
+                    except sqlite3.Error as e:
+                        self.write_errors += 1
+                        self.last_error = str(e)
+                        results.append((fut, None, e))
+                conn.execute('COMMIT')
+                self.commit_latency.record(time.monotonic() - start)
+                self.batches += 1
+                self.rows += sum(1 for r in results if r[2] is None)
+            except Exception as e:
+                self.commit_errors += 1
+                self.last_error = str(e)
+                try:
+                    self._conn.close()
+                except:
+                    pass
+                self._conn = None       # reconnect on the next batch
+                results = [(fut, None, e) for _, _, fut in batch]
+            for fut, rowid, err in results:
+                if fut is None:
+                    continue
+                if err is None:
+                    fut.set_result(rowid)
+                else:
+                    fut.set_exception(err)
+            with self._idle:
+                self._inflight -= len(batch)
+                if not self._inflight:
+                    self._idle.notify_all()
+
+    # === Reads ===
+
+    def _connect_reader(self):
+        conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+        conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA query_only=1')
+        self.readers_opened += 1
+        return conn
+
+    def query(self, sql, params=()):
+        """Run a SELECT on a pooled read-only connection; returns all rows"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect_reader()
+        start = time.monotonic()
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        except sqlite3.Error:
+            self.query_errors += 1
+            conn.close()            # don't hand a possibly broken handle to the next request
+            raise
+        with self._lock:
+            self.queries += 1
+            self.query_latency.record(time.monotonic() - start)
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+        return rows
+
+    def stats(self):
+        with self._lock:
+            return {
+                'path': self.path,
+                'queue_depth': self._queue.qsize(),
+                'max_queue_depth': self.max_depth,
+                'inflight': self._inflight,
+                'batches': self.batches,
+                'rows': self.rows,
+                'rows_per_batch': round(self.rows / self.batches, 1) if self.batches else None,
+                'dropped': self.dropped,
+                'write_errors': self.write_errors,
+                'commit_errors': self.commit_errors,
+                'commit_latency': self.commit_latency.summary(),
+                'queries': self.queries,
+                'query_errors': self.query_errors,
+                'query_latency': self.query_latency.summary(),
+                'pooled_readers': self._pool.qsize(),
+                'readers_opened': self.readers_opened,
+                'synchronous': self.synchronous,
+                'last_error': self.last_error,
+            }
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_db(path=DB_PATH):
+    """Process-wide TrainingDB for path; pending writes are flushed at exit"""
+    with _shared_lock:
+        db = _shared.get(path)
+        if db is None:
+            db = _shared[path] = TrainingDB(path)
+            atexit.register(db.flush)
+        return db
@@ -0,0 +1,52 @@
+"""MediaStats/MediaFlow: per-direction rate and jitter from captured arrivals"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+from flowtable import FlowDeltas, MediaFlow, ip_int, pack_key  # noqa: E402
+
+A = ip_int('10.0.0.2')
+B = ip_int('203.0.113.9')
+
+
+class MediaFlowTest(unittest.TestCase):
+    def feed(self, packets):
+        """packets: [(src, sport, dst, dport, ts)] in arrival order -> MediaFlow"""
+        deltas = FlowDeltas()
+        key = pack_key('udp', A, 20000, B, 30000)
+        media = deltas.media[key] = MediaFlow(A, 20000)
+        for src, sport, dst, dport, ts in sorted(packets, key=lambda p: p[4]):
+            deltas.add('udp', src, sport, dst, dport, 200, ts)
+        return media
+
+    def stream(self, src, sport, dst, dport, offset=0.0, seconds=20, interval=0.02):
+        return [(src, sport, dst, dport, offset + i * interval) for i in range(int(seconds / interval))]
+
+    def assertClean(self, stats):
+        d = stats.as_dict(0)
+        self.assertAlmostEqual(d['pps'], 50, delta=1)
+        self.assertLess(d['jitter_ms'], 0.5)
+        self.assertEqual(d['missing'], 0)
+
+    def test_duplicated_bidirectional(self):
+        # Both directions 7 ms apart, every packet captured on ingress and again 50 us later on egress
+        fwd = self.stream(A, 20000, B, 30000)
+        rev = self.stream(B, 30000, A, 20000, offset=0.007)
+        dups = [(s, sp, d, dp, ts + 0.00005) for s, sp, d, dp, ts in fwd + rev]
+        media = self.feed(fwd + rev + dups)
+        self.assertClean(media.fwd)
+        self.assertClean(media.rev)
+
+    def test_outage_in_one_direction(self):
+        fwd = [p for p in self.stream(A, 20000, B, 30000) if not 5 <= p[4] < 6]
+        rev = self.stream(B, 30000, A, 20000, offset=0.007)
+        media = self.feed(fwd + rev)
+        self.assertGreaterEqual(media.fwd.max_gap, 1.0)
+        self.assertAlmostEqual(media.fwd.missing, 49, delta=2)
+        self.assertLess(media.rev.max_gap, 0.03)
+        self.assertEqual(media.rev.missing, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
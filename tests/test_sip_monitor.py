@@ -0,0 +1,61 @@
+"""sip-monitor transaction timing: captured copies are not retransmissions"""
+import importlib.util
+import os
+import sys
+import unittest
+
+SCRIPTS = os.path.join(os.path.dirname(__file__), '..', 'scripts')
+sys.path.insert(0, SCRIPTS)
+from sipparse import parse_datagram  # noqa: E402
+
+spec = importlib.util.spec_from_file_location('sip_monitor', os.path.join(SCRIPTS, 'sip-monitor.py'))
+sip_monitor = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(sip_monitor)
+
+INVITE = (b'INVITE sip:bob@example.com SIP/2.0\r\n'
+          b'Via: SIP/2.0/UDP 10.0.0.2:5060;branch=z9hG4bK1\r\n'
+          b'From: <sip:alice@example.com>;tag=a1\r\n'
+          b'To: <sip:bob@example.com>\r\n'
+          b'Call-ID: call-1@10.0.0.2\r\n'
+          b'CSeq: 1 INVITE\r\n'
+          b'Content-Length: 0\r\n\r\n')
+RINGING = INVITE.replace(b'INVITE sip:bob@example.com SIP/2.0', b'SIP/2.0 180 Ringing')
+OK = INVITE.replace(b'INVITE sip:bob@example.com SIP/2.0', b'SIP/2.0 200 OK')
+
+
+class TransactionCopiesTest(unittest.TestCase):
+    def setUp(self):
+        sip_monitor.calls = sip_monitor.SipStore(sip_monitor.CALL_CAPACITY)
+        sip_monitor.transactions = sip_monitor.SipStore(sip_monitor.TXN_CAPACITY)
+        sip_monitor.timing.clear()
+        sip_monitor.active_uplink = 'cell_a'
+
+    def send(self, payload, ts, copies=2):
+        # Each packet captured on ingress and again ~50 us later on egress
+        for i in range(copies):
+            for msg in parse_datagram(payload):
+                sip_monitor.process_sip(msg, ts + i * 0.00005)
+
+    def test_duplicate_copies(self):
+        self.send(INVITE, 100.0)
+        self.send(RINGING, 100.3)
+        self.send(OK, 101.0)
+        t = sip_monitor.timing_summary()['cell_a']
+        self.assertEqual(t['transactions'], 1)
+        self.assertEqual(t['retransmissions'], {})
+        self.assertEqual(t['response_retransmissions'], 0)
+        self.assertEqual(sip_monitor.calls.get('call-1@10.0.0.2')['retransmissions'], 0)
+
+    def test_real_retransmissions(self):
+        self.send(INVITE, 100.0)
+        self.send(INVITE, 100.5)        # T1
+        self.send(OK, 101.0)
+        self.send(OK, 101.5)            # 200 OK retransmitted until the ACK
+        t = sip_monitor.timing_summary()['cell_a']
+        self.assertEqual(t['retransmissions'], {'INVITE': 1})
+        self.assertEqual(t['response_retransmissions'], 1)
+        self.assertEqual(sip_monitor.calls.get('call-1@10.0.0.2')['retransmissions'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,11 +15,23 @@ Features:
 
 import json
 import os
+import sys
 import time
-import sqlite3
 from datetime import datetime
+from functools import lru_cache
 from flask import Flask, render_template, jsonify, request, Response
+
+# Shared helpers that live alongside the daemons in scripts/ (rtnl/nsexec
+# use scripts/netns.py, so this goes before the local imports)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
 from diagnostics import diag_bp
+from status_snapshot import JsonFileCache, StatusSnapshot
+from broadcast import StatusBroadcaster
+from jsondelta import DeltaEncoder
+import nsexec
+from runwatch import shared_watcher
+from trainingdb import shared_db
+from heattiles import HeatTiler, UPLINKS, ZOOMS
 
 app = Flask(__name__)
 
@@ -34,115 +46,119 @@ def map_uplink(name):
 
 # Paths
 STATUS_PATH = '/run/pathsteer/status.json'
+GPS_PATH = '/run/pathsteer/gps.json'
 COMMAND_PATH = '/run/pathsteer/command'
 CONFIG_PATH = os.environ.get('CONFIG_FILE', '/etc/pathsteer/config.json')
 DB_PATH = '/opt/pathsteer/data/training.db'
 
+# Batched writer thread + pooled read-only connections, shared by the endpoints below
+db = shared_db(DB_PATH)
+# Pre-aggregated heat map cells, folded in from samples as they arrive
+heat_tiler = HeatTiler(db)
+
+# Parsed-file caches: only re-read when inode/mtime/size change
+_status_file = JsonFileCache(STATUS_PATH)
+_config_file = JsonFileCache(CONFIG_PATH)
+_gps_file = JsonFileCache(GPS_PATH)
+
 def get_config():
-    """Load configuration"""
-    try:
-        with open(CONFIG_PATH) as f:
-            return json.load(f)
-    except:
-        return {}
+    """Load configuration (cached until the file changes; treat as read-only)"""
+    config, _ = _config_file.load()
+    return config if isinstance(config, dict) else {}
 
 
-# Throughput tracking
-_prev_bytes = {}
-_prev_time = 0
+# Throughput tracking: link dumps on the ns_vip nsexec worker, no subprocesses
+vip_counters = nsexec.LinkCounters('ns_vip', prefix='vip_')
 
 def get_throughput():
-    global _prev_bytes, _prev_time
-    import subprocess
-    now = time.time()
+    """(down_mbps, up_mbps) measured on vip_wifi_i"""
     try:
-        out = subprocess.check_output(
-            ["ip", "netns", "exec", "ns_vip", "cat", "/proc/net/dev"],
-            text=True, timeout=1)
-    except:
+        rates = vip_counters.sample()
+    except OSError:
         return 0, 0
-    curr = {}
-    for line in out.strip().split("\n"):
-        if ":" not in line or "face" in line:
-            continue
-        iface, data = line.split(":", 1)
-        iface = iface.strip()
-        if iface.startswith("vip_"):
-            fields = data.split()
-            curr[iface] = {"rx": int(fields[0]), "tx": int(fields[8])}
-
     # vip_wifi_i is the measurement point: all client traffic passes through it
     # TX on wifi = download TO clients, RX on wifi = upload FROM clients
-    wifi = curr.get('vip_wifi_i', {})
-    cur_down = wifi.get('tx', 0)
-    cur_up = wifi.get('rx', 0)
-
-    prev_wifi = _prev_bytes.get('vip_wifi_i', {})
-    prev_down = prev_wifi.get('tx', 0)
-    prev_up = prev_wifi.get('rx', 0)
-
-    dt = now - _prev_time if _prev_time > 0 else 1
-    if dt < 0.05:
-        dt = 0.1  # avoid division spikes
+    wifi = rates.get('vip_wifi_i', {})
+    down_mbps = wifi.get('tx_bps', 0) / 1_000_000
+    up_mbps = wifi.get('rx_bps', 0) / 1_000_000
+    return max(0, round(down_mbps, 2)), max(0, round(up_mbps, 2))
 
-    down_mbps = ((cur_down - prev_down) * 8 / dt / 1_000_000) if _prev_time > 0 and cur_down >= prev_down else 0
-    up_mbps = ((cur_up - prev_up) * 8 / dt / 1_000_000) if _prev_time > 0 and cur_up >= prev_up else 0
+@lru_cache(maxsize=8)
+def _run_start(run_id):
+    """Parse run_id (YYYYmmdd_HHMMSS, UTC) once per run"""
+    try:
+        return datetime.strptime(run_id, "%Y%m%d_%H%M%S")
+    except ValueError:
+        return None
+
+OFFLINE_STATUS = {
+    'mode': 'OFFLINE',
+    'state': 'OFFLINE',
+    'trigger': 'none',
+    'active_uplink': 'unknown',
+    'dup_enabled': False,
+    'hold_remaining': 0,
+    'clean_remaining': 0,
+    'flap_suppressed': False,
+    'global_risk': 0,
+    'recommendation': 'OFFLINE',
+    'run_id': '--',
+    'node_id': 'offline',
+    'gps': {'valid': False, 'lat': 0, 'lon': 0, 'speed_mph': 0, 'heading': 0},
+    'uplinks': []
+}
 
-    _prev_bytes = curr
-    _prev_time = now
-    return max(0, round(down_mbps, 2)), max(0, round(up_mbps, 2))
+def _build_status():
+    """Merge daemon status, config, throughput and GPS into one document.
+
+    Returns (status, raw_status_text). Called once per tick by the snapshot.
+    """
+    daemon, raw = _status_file.load()
+    if not isinstance(daemon, dict):
+        return dict(OFFLINE_STATUS), None
+    # Shallow copy: the cached parse of status.json must stay pristine
+    status = dict(daemon)
+    # Add config info
+    config = get_config()
+    status['node_id'] = config.get('node', {}).get('id', 'unknown')
+    down, up = get_throughput()
+    status["throughput_down_mbps"] = down
+    status["throughput_up_mbps"] = up
+    # Calculate uptime from run_id
+    run_id = status.get("run_id", "")
+    if run_id:
+        start = _run_start(run_id)
+        status["uptime_display"] = "--"
+        if start is not None:
+            total_min = int((datetime.utcnow() - start).total_seconds() // 60)
+            if total_min >= 0:
+                status["uptime_display"] = f"{total_min // 60}h {total_min % 60}m"
+    status['topology_mode'] = config.get('topology_mode', 'chaos')
+    # Merge GPS data
+    gps_data, _ = _gps_file.load()
+    if isinstance(gps_data, dict):
+        status['gps'] = {'valid': gps_data.get('fix', False), 'lat': gps_data.get('lat', 0), 'lon': gps_data.get('lon', 0), 'speed_mph': 0, 'heading': 0}
+    return status, raw
+
+# One merged status per 100 ms tick, shared by every reader
+status_snapshot = StatusSnapshot(_build_status, tick=0.1)
+
+# Rebuild as soon as the daemon or GPS replaces its file
+STATUS_FILES = ('status.json', 'gps.json')
+run_watch = shared_watcher()
+run_watch.on_change(STATUS_FILES, lambda name: status_snapshot.invalidate())
+
+def _status_waker():
+    """wake() for a broadcaster: block until a status input file changes"""
+    token = run_watch.token()
+    return lambda timeout: run_watch.wait(STATUS_FILES, token, timeout)
 
 def get_status():
-    """Read current status from daemon"""
+    """Current merged status (shared snapshot - do not mutate)"""
     try:
-        with open(STATUS_PATH) as f:
-            status = json.load(f)
-            # Add config info
-            config = get_config()
-            status['node_id'] = config.get('node', {}).get('id', 'unknown')
-            down, up = get_throughput()
-            status["throughput_down_mbps"] = down
-            status["throughput_up_mbps"] = up
-            # Calculate uptime from run_id
-            run_id = status.get("run_id", "")
-            if run_id:
-                try:
-                    from datetime import datetime
-                    start = datetime.strptime(run_id, "%Y%m%d_%H%M%S")
-                    delta = datetime.utcnow() - start
-                    total_min = int(delta.total_seconds() // 60)
-                    if total_min >= 0:
-                        status["uptime_display"] = f"{total_min // 60}h {total_min % 60}m"
-                    else:
-                        status["uptime_display"] = "--"
-                except:
-                    status["uptime_display"] = "--"
-            status['topology_mode'] = config.get('topology_mode', 'chaos')
-            # Merge GPS data
-            try:
-                with open('/run/pathsteer/gps.json') as gf:
-                    gps_data = json.load(gf)
-                    status['gps'] = {'valid': gps_data.get('fix', False), 'lat': gps_data.get('lat', 0), 'lon': gps_data.get('lon', 0), 'speed_mph': 0, 'heading': 0}
-            except:
-                pass
-            return status
-    except:
-        return {
-            'mode': 'OFFLINE',
-            'state': 'OFFLINE',
-            'trigger': 'none',
-            'active_uplink': 'unknown',
-            'dup_enabled': False,
-            'hold_remaining': 0,
-            'clean_remaining': 0,
-            'flap_suppressed': False,
-            'global_risk': 0,
-            'recommendation': 'OFFLINE',
-            'run_id': '--',
-            'node_id': 'offline',
-            'gps': {'valid': False, 'lat': 0, 'lon': 0, 'speed_mph': 0, 'heading': 0},
-            'uplinks': []
-        }
+        return status_snapshot.get().data
+    except Exception:
+        return OFFLINE_STATUS
 
 def send_command(cmd):
     """Send command to daemon"""
@@ -163,23 +179,72 @@ def index():
 
 @app.route('/api/status')
 def api_status():
-    return jsonify(get_status())
+    try:
+        body = status_snapshot.get().body
+    except Exception:
+        return jsonify(OFFLINE_STATUS)
+    return Response(body, mimetype='application/json')
+
+@app.route('/api/status/cache')
+def api_status_cache():
+    """Snapshot hit/miss and per-file parse counters"""
+    return jsonify({
+        'snapshot': status_snapshot.stats(),
+        'files': [c.stats() for c in (_status_file, _config_file, _gps_file)],
+    })
+
+@app.route('/api/throughput/interfaces')
+def api_throughput_interfaces():
+    """Per-interface rates for every vip_* link, from the last status tick"""
+    status_snapshot.get()
+    return jsonify({'timestamp': vip_counters.sampled_at, 'namespace': vip_counters.ns,
+                    'interfaces': vip_counters.last_rates})
 
 @app.route('/api/config')
 def api_config():
     return jsonify(get_config())
 
+def _encode_sse(snap):
+    """One SSE frame per snapshot, encoded once for all subscribers"""
+    return b"data: " + snap.body.encode() + b"\n\n"
+
+# Single 10 Hz producer fanned out to every /api/stream client
+status_stream = StatusBroadcaster(status_snapshot, _encode_sse, interval=0.1,
+                                  wake=_status_waker())
+
+# Opt-in keyframe + delta stream (/api/stream?mode=delta), see jsondelta.py
+delta_encoder = DeltaEncoder(keyframe_interval=5.0)
+status_delta_stream = StatusBroadcaster(status_snapshot, delta_encoder, interval=0.1,
+                                        keyframe=delta_encoder.keyframe,
+                                        wake=_status_waker())
+
 @app.route('/api/stream')
 def api_stream():
-    """Server-sent events for real-time updates"""
-    def generate():
-        while True:
-            status = get_status()
-            yield f"data: {json.dumps(status)}\n\n"
-            time.sleep(0.1)  # 10 Hz
-    return Response(generate(), mimetype='text/event-stream',
+    """Server-sent events for real-time updates (?mode=delta for patches)"""
+    if request.args.get('mode') == 'delta':
+        frames = status_delta_stream.stream()
+    else:
+        frames = status_stream.stream()
+    return Response(frames, mimetype='text/event-stream',
                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
+@app.route('/api/stream/keyframe')
+def api_stream_keyframe():
+    """Current full state + seq, for delta clients resyncing after a gap"""
+    seq, data = delta_encoder.current()
+    if data is None:
+        data = get_status()
+    return jsonify({'type': 'key', 'seq': seq, 'data': data})
+
+@app.route('/api/stream/stats')
+def api_stream_stats():
+    """Subscriber count and fan-out counters"""
+    return jsonify({
+        'full': status_stream.stats(),
+        'delta': dict(status_delta_stream.stats(), **delta_encoder.stats()),
+        'watcher': run_watch.stats(),
+    })
+
 @app.route('/api/control/mode', methods=['POST'])
 def api_set_mode():
     """Set operating mode: training, tripwire, mirror"""
@@ -225,14 +290,10 @@ def api_events():
     """Get recent events from database"""
     limit = request.args.get('limit', 50, type=int)
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''
+        rows = db.query('''
             SELECT timestamp, event_type, trigger, description, latitude, longitude
             FROM events ORDER BY timestamp DESC LIMIT ?
         ''', (limit,))
-        rows = cursor.fetchall()
-        conn.close()
         return jsonify([{
             'timestamp': r[0], 'type': r[1], 'trigger': r[2],
             'description': r[3], 'lat': r[4], 'lon': r[5]
@@ -242,67 +303,89 @@ def api_events():
 
 @app.route('/api/heatmap')
 def api_heatmap():
-    """Get GPS + signal data for heat map"""
+    """Pre-aggregated signal/risk tiles inside a bounding box.
+
+    ?zoom= picks the cell level (snapped down to a stored one), ?bbox= is
+    min_lat,min_lon,max_lat,max_lon, ?uplink= is cell_a, cell_b or the
+    default 'active' (metrics of whichever uplink was carrying traffic).
+    The older ?hours= form still returns raw samples (with speed) from that
+    window, see heatmap_samples().
+    """
+    heat_tiler.start()
+    if request.args.get('hours'):
+        return heatmap_samples()
+    zoom = request.args.get('zoom', ZOOMS[-1], type=int)
+    uplink = request.args.get('uplink') or 'active'
+    bbox = request.args.get('bbox')
+    if uplink not in UPLINKS:
+        return jsonify({'error': f"uplink must be one of {', '.join(UPLINKS)}"}), 400
+    try:
+        if bbox:
+            bbox = [float(v) for v in bbox.split(',')]
+            if len(bbox) != 4:
+                return jsonify({'error': 'bbox is min_lat,min_lon,max_lat,max_lon'}), 400
+        return jsonify(heat_tiler.tiles(zoom, bbox, uplink))
+    except ValueError:
+        return jsonify({'error': 'bbox is min_lat,min_lon,max_lat,max_lon'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def heatmap_samples():
+    """Raw GPS + signal samples from the last ?hours=, optionally one ?uplink="""
     hours = request.args.get('hours', 24, type=int)
     uplink = request.args.get('uplink', None)
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
         query = '''
-            SELECT lat, lon, risk, active_uplink, 
+            SELECT lat, lon, risk, active_uplink,
                    cell_a_rsrp, cell_a_sinr, cell_a_rtt, cell_b_rsrp, cell_b_sinr, cell_b_rtt, speed
-            FROM samples 
+            FROM samples
             WHERE lat IS NOT NULL AND lat != 0
-              AND timestamp > datetime('now', '-' || ? || ' hours')
+              AND datetime(timestamp) > datetime('now', '-' || ? || ' hours')
         '''
         params = [hours]
-        
-        if uplink:
-            query += ' AND uplink = ?'
+
+        if uplink and uplink != 'active':
+            query += ' AND active_uplink = ?'
             params.append(uplink)
-            
-        query += ' ORDER BY timestamp DESC LIMIT 5000'
-        
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
-        
+
+        query += ' ORDER BY rowid DESC LIMIT 5000'
+
         results = []
-        for r in rows:
+        for r in db.query(query, params):
             if not r[0] or not r[1]:
                 continue
-            uplink = r[3]
+            active = r[3]
             # cell_a=TMO (index 4,5,6), cell_b=ATT (index 7,8,9)
-            if uplink == 'cell_a':
+            if active == 'cell_a':
                 rsrp, sinr, rtt = r[4], r[5], r[6]
-            elif uplink == 'cell_b':
+            elif active == 'cell_b':
                 rsrp, sinr, rtt = r[7], r[8], r[9]
             else:
                 rsrp, sinr, rtt = 0, 0, r[6] or r[9] or 0
             results.append({
                 'lat': r[0], 'lng': r[1], 'risk': r[2] or 0,
-                'uplink': uplink, 'rsrp': rsrp, 'sinr': sinr,
+                'uplink': active, 'rsrp': rsrp, 'sinr': sinr,
                 'rtt': rtt, 'speed': r[10]
             })
         return jsonify(results)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/heatmap/stats')
+def api_heatmap_stats():
+    """Tiler progress: sample cursor, cells written, last pass time"""
+    return jsonify(heat_tiler.stats())
+
 @app.route('/api/risk_zones')
 def api_risk_zones():
     """Get learned risk zones"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''
+        rows = db.query('''
             SELECT latitude, longitude, uplink, risk_score, sample_count,
                    heading_min, heading_max
             FROM risk_zones WHERE risk_score > 0.3
             ORDER BY risk_score DESC LIMIT 500
         ''')
-        rows = cursor.fetchall()
-        conn.close()
         return jsonify([{
             'lat': r[0], 'lng': r[1], 'uplink': r[2],
             'risk': r[3], 'samples': r[4],
@@ -443,14 +526,10 @@ def api_log_event():
     detail = data.get('detail', '')
     
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
+        db.write_wait(
             'INSERT INTO events (type, message, detail) VALUES (?, ?, ?)',
             (event_type, message, detail)
         )
-        conn.commit()
-        conn.close()
         return jsonify({'status': 'ok'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -462,9 +541,6 @@ def api_events_history():
     event_type = request.args.get('type', None)
     
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
         query = 'SELECT timestamp, type, message, detail FROM events'
         params = []
         
@@ -475,15 +551,18 @@ def api_events_history():
         query += ' ORDER BY timestamp DESC LIMIT ?'
         params.append(limit)
         
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
+        rows = db.query(query, params)
         
         events = [{'timestamp': r[0], 'type': r[1], 'message': r[2], 'detail': r[3]} for r in rows]
         return jsonify(events)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/db/stats')
+def api_db_stats():
+    """training.db writer queue depth, batching, commit/query latency"""
+    return jsonify(db.stats())
+
 
 # =============================================================================
 # SETTINGS PAGE
@@ -680,6 +759,21 @@ def api_sip_status():
     except:
         return jsonify({'active_calls': 0, 'calls': [], 'regs': []})
 
+SIP_TIMING_PATH = '/run/pathsteer/sip-timing.json'
+_sip_timing_file = JsonFileCache(SIP_TIMING_PATH)
+
+@app.route('/api/sip/timing')
+def api_sip_timing():
+    """SIP transaction timing per uplink (post-dial delay, setup time, REGISTER RTT)"""
+    data, _ = _sip_timing_file.load()
+    if data is None:
+        return jsonify({'active_uplink': None, 'timing': {}})
+    uplink = request.args.get('uplink')
+    if uplink:
+        return jsonify({'uplink': uplink, 'timing': data.get('timing', {}).get(uplink, {}),
+                        'updated': data.get('updated')})
+    return jsonify(data)
+
 # =============================================================================
 # EVENT LOG API
 # =============================================================================
@@ -721,10 +815,12 @@ def api_log_query():
 def api_log_status_json():
     """Read latest daemon status with full uplink details"""
     try:
-        with open('/run/pathsteer/status.json', 'r') as f:
-            return jsonify(json.load(f))
-    except:
+        raw = status_snapshot.get().raw_body
+    except Exception:
+        raw = None
+    if raw is None:
         return jsonify({})
+    return Response(raw, mimetype='application/json')
 
 app.register_blueprint(diag_bp, url_prefix='/diag')
 
@@ -752,5 +848,6 @@ if __name__ == '__main__':
     # Ensure directories exist
     os.makedirs('/run/pathsteer', exist_ok=True)
     os.makedirs('/opt/pathsteer/data/logs', exist_ok=True)
+    heat_tiler.start()
     app.run(host='0.0.0.0', port=8080, debug=False, threaded=True)
 
@@ -0,0 +1,182 @@
+"""PathSteer Guardian - SSE fan-out for /api/stream
+
+A single producer thread turns each status snapshot into one pre-encoded
+SSE frame and pushes the same bytes to every subscriber.  Each subscriber
+has a small bounded queue; when a client falls behind its backlog is
+coalesced down to the newest frame, and a client that stops reading
+altogether is dropped.
+
+Stateful streams (delta mode) pass a keyframe callable: new subscribers
+and subscribers whose backlog overflowed get a fresh keyframe instead of
+a frame that depends on ones they never saw.
+"""
+import queue
+import threading
+import time
+
+KEEPALIVE = b": keepalive\n\n"
+
+
+class Subscriber:
+    __slots__ = ('q', 'last_read', 'closed', 'coalesced')
+
+    def __init__(self, maxsize):
+        self.q = queue.Queue(maxsize=maxsize)
+        self.last_read = time.time()
+        self.closed = False
+        self.coalesced = 0
+
+
+class StatusBroadcaster:
+    """One producer, N subscribers, identical frames.
+
+    encode(snapshot) -> bytes builds the frame; it runs once per tick no
+    matter how many clients are connected, and may return None to skip a
+    tick.  keyframe() -> bytes, if given, resyncs a subscriber.
+
+    Without wake the producer ticks every interval.  With wake(timeout),
+    a callable that blocks until an input file changes, it ticks as soon
+    as something changes (but never more often than interval) and at
+    least every idle_interval.
+    """
+
+    def __init__(self, snapshot, encode, interval=0.1, queue_size=8,
+                 stall_timeout=30.0, keepalive=15.0, keyframe=None,
+                 wake=None, idle_interval=1.0):
+        self.snapshot = snapshot
+        self.encode = encode
+        self.keyframe = keyframe
+        self.wake = wake
+        self.idle_interval = idle_interval
+        self.interval = interval
+        self.queue_size = queue_size
+        self.stall_timeout = stall_timeout
+        self.keepalive = keepalive
+        self._lock = threading.Lock()
+        self._subs = set()
+        self._thread = None
+        self._last_frame = None
+        self.frames = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.encode_ms = 0.0
+
+    # --- subscriber side ---
+    def subscribe(self):
+        sub = Subscriber(self.queue_size)
+        with self._lock:
+            self._subs.add(sub)
+            # Late joiners get the current frame straight away
+            first = self.keyframe() if self.keyframe else self._last_frame
+            if first is not None:
+                sub.q.put_nowait(first)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        sub.closed = True
+        with self._lock:
+            self._subs.discard(sub)
+
+    def stream(self):
+        """Generator for a Flask Response: yields pre-encoded frames"""
+        sub = self.subscribe()
+        try:
+            while not sub.closed:
+                try:
+                    frame = sub.q.get(timeout=self.keepalive)
+                except queue.Empty:
+                    # Lets the server notice a dead socket on an idle stream
+                    yield KEEPALIVE
+                    continue
+                if frame is None:
+                    break
+                sub.last_read = time.time()
+                yield frame
+        finally:
+            self.unsubscribe(sub)
+
+    # --- producer side ---
+    def _offer(self, sub, frame):
+        try:
+            sub.q.put_nowait(frame)
+            return
+        except queue.Full:
+            pass
+        # Backlogged: throw away what it has not read yet, keep only the newest
+        try:
+            while True:
+                sub.q.get_nowait()
+                sub.coalesced += 1
+                self.coalesced += 1
+        except queue.Empty:
+            pass
+        if self.keyframe:
+            # Dropped deltas broke the chain - restart it from full state
+            frame = self.keyframe() or frame
+        try:
+            sub.q.put_nowait(frame)
+        except queue.Full:
+            pass
+
+    def _publish(self, frame):
+        now = time.time()
+        with self._lock:
+            self._last_frame = frame
+            subs = list(self._subs)
+        for sub in subs:
+            if now - sub.last_read > self.stall_timeout and sub.q.full():
+                # Not reading at all - stop feeding it and wake it to exit
+                self.dropped += 1
+                self.unsubscribe(sub)
+                try:
+                    sub.q.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    sub.q.put_nowait(None)
+                except queue.Full:
+                    pass
+                continue
+            self._offer(sub, frame)
+        self.frames += 1
+
+    def _run(self):
+        last_seq = None
+        while True:
+            with self._lock:
+                if not self._subs:
+                    self._thread = None
+                    self._last_frame = None
+                    return
+            started = time.time()
+            try:
+                snap = self.snapshot.get()
+                if snap.seq != last_seq:
+                    last_seq = snap.seq
+                    frame = self.encode(snap)
+                    self.encode_ms = round((time.time() - started) * 1000, 3)
+                    if frame is not None:
+                        self._publish(frame)
+            except Exception:
+                pass
+            time.sleep(max(0.0, self.interval - (time.time() - started)))
+            if self.wake is not None:
+                try:
+                    self.wake(self.idle_interval)
+                except Exception:
+                    time.sleep(self.idle_interval)
+
+    def stats(self):
+        with self._lock:
+            subs = list(self._subs)
+        return {
+            'subscribers': len(subs),
+            'frames': self.frames,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'last_encode_ms': self.encode_ms,
+            'max_backlog': max((s.q.qsize() for s in subs), default=0),
+        }
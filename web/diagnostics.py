@@ -1,6 +1,9 @@
 """PathSteer Guardian - Diagnostics & Stats API (Blueprint)"""
-import subprocess, re, time, json, os, threading
+import subprocess, time, json, os, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from flask import Blueprint, jsonify, request, render_template
+import nsexec
 
 diag_bp = Blueprint('diagnostics', __name__)
 
@@ -16,27 +19,30 @@ UPLINK_LABELS = {'fa':'Fiber A','fb':'Fiber B','sl_a':'Starlink A','sl_b':'Starl
 TUNNEL_CONTROLLER = {'wg-fa-cA':'A','wg-fa-cB':'B','wg-fb-cA':'A','wg-fb-cB':'B','wg-sa-cA':'A','wg-sa-cB':'B','wg-sb-cA':'A','wg-sb-cB':'B','wg-ca-cA':'A','wg-ca-cB':'B','wg-cb-cA':'A','wg-cb-cB':'B'}
 
 # --- Throughput sampling ---
+# Read through the per-namespace nsexec workers: a single RTM_GETLINK dump
+# returns both tunnels' counters, so a 10 Hz pass costs 6 dumps and no forks.
+SAMPLE_INTERVAL = 0.1
+SAMPLE_HISTORY = 600  # 60 s at 10 Hz
 _throughput_lock = threading.Lock()
-_throughput_samples = []  # list of {timestamp, uplink, rx_bps, tx_bps}
+_throughput_samples = deque(maxlen=SAMPLE_HISTORY)  # {timestamp, tunnels: [...]}
 _prev_bytes = {}  # key: "ns/tun" -> {rx, tx, ts}
+_tunnel_counters = {ns: nsexec.LinkCounters(ns, prefix='wg-') for ns in WG_TUNNEL_MAP}
 
 def _sample_throughput():
     """Read WG byte counters and compute rates"""
-    global _prev_bytes
     now = time.time()
     samples = []
     for ns, tun_list in WG_TUNNEL_MAP.items():
+        try:
+            links = _tunnel_counters[ns].read()
+        except OSError:
+            continue
         for tname, _ in tun_list:
             key = f"{ns}/{tname}"
-            try:
-                rx = int(subprocess.check_output(
-                    ['ip','netns','exec',ns,'cat',f'/sys/class/net/{tname}/statistics/rx_bytes'],
-                    text=True, timeout=2).strip())
-                tx = int(subprocess.check_output(
-                    ['ip','netns','exec',ns,'cat',f'/sys/class/net/{tname}/statistics/tx_bytes'],
-                    text=True, timeout=2).strip())
-            except:
+            link = links.get(tname)
+            if link is None or 'rx_bytes' not in link:
                 continue
+            rx, tx = link['rx_bytes'], link['tx_bytes']
             if key in _prev_bytes:
                 prev = _prev_bytes[key]
                 dt = now - prev['ts']
@@ -53,68 +59,130 @@ def _sample_throughput():
             _prev_bytes[key] = {'rx': rx, 'tx': tx, 'ts': now}
     with _throughput_lock:
         _throughput_samples.append({'timestamp': now, 'tunnels': samples})
-        if len(_throughput_samples) > 300:
-            _throughput_samples[:] = _throughput_samples[-300:]
     return samples
 
 def _bg_sampler():
     while True:
+        started = time.time()
         try:
             _sample_throughput()
         except:
             pass
-        time.sleep(2)
+        time.sleep(max(0.0, SAMPLE_INTERVAL - (time.time() - started)))
 
 _sampler_thread = threading.Thread(target=_bg_sampler, daemon=True)
 _sampler_thread.start()
 
 # --- Helpers ---
-def _to_bytes(v,u):
-    m={'B':1,'KiB':1024,'MiB':1048576,'GiB':1073741824}
-    return int(v*m.get(u,1))
-
 def _format_bytes(b):
     if b>=1073741824: return f"{b/1073741824:.2f} GiB"
     if b>=1048576: return f"{b/1048576:.2f} MiB"
     if b>=1024: return f"{b/1024:.1f} KiB"
     return f"{b} B"
 
-def _parse_wg_show(ns, tunnel):
+def _format_age(sec):
+    parts=[]
+    for n,u in ((sec//86400,'day'),(sec%86400//3600,'hour'),(sec%3600//60,'minute'),(sec%60,'second')):
+        if n: parts.append(f"{n} {u}{'s' if n!=1 else ''}")
+    return (', '.join(parts) or '0 seconds')+' ago'
+
+# --- WireGuard state ---
+# `wg show all dump` is tab-separated machine output with exact byte counters
+# and epoch handshake times; one call covers every tunnel in a namespace.
+WG_CACHE_TTL = float(os.environ.get('WG_CACHE_TTL', '2'))
+_wg_cache = {}  # ns -> (fetched_at, {tunnel: peer info} or None on failure)
+_wg_cache_lock = threading.Lock()
+
+def _wg_dump(ns):
     try:
-        out=subprocess.check_output(['ip','netns','exec',ns,'wg','show',tunnel],text=True,timeout=3,stderr=subprocess.DEVNULL)
+        out=subprocess.check_output(['ip','netns','exec',ns,'wg','show','all','dump'],text=True,timeout=3,stderr=subprocess.DEVNULL)
     except:
         return None
-    r={'tunnel':tunnel,'namespace':ns,'controller':TUNNEL_CONTROLLER.get(tunnel,'?'),'peer':'','endpoint':'','last_handshake_sec':-1,'last_handshake_display':'never','tx_bytes':0,'rx_bytes':0,'allowed_ips':''}
-    for line in out.strip().split('\n'):
-        line=line.strip()
-        if line.startswith('peer:'): r['peer']=line.split(':',1)[1].strip()
-        elif line.startswith('endpoint:'): r['endpoint']=line.split(':',1)[1].strip()
-        elif line.startswith('allowed ips:'): r['allowed_ips']=line.split(':',1)[1].strip()
-        elif line.startswith('latest handshake:'):
-            hs=line.split(':',1)[1].strip(); r['last_handshake_display']=hs; total=0
-            for m in re.finditer(r'(\d+)\s+(hour|minute|second)',hs):
-                v,u=int(m.group(1)),m.group(2); total+=v*3600 if u=='hour' else v*60 if u=='minute' else v
-            r['last_handshake_sec']=total
-        elif line.startswith('transfer:'):
-            ts=line.split(':',1)[1].strip(); r['transfer_display']=ts
-            rx=re.search(r'([\d.]+)\s+(B|KiB|MiB|GiB)\s+received',ts)
-            tx=re.search(r'([\d.]+)\s+(B|KiB|MiB|GiB)\s+sent',ts)
-            if rx: r['rx_bytes']=_to_bytes(float(rx.group(1)),rx.group(2))
-            if tx: r['tx_bytes']=_to_bytes(float(tx.group(1)),tx.group(2))
+    peers={}
+    for line in out.splitlines():
+        f=line.split('\t')
+        # Interface lines have 5 fields (incl. private key) - never exported
+        if len(f)!=9: continue
+        tun,pub,_psk,endpoint,allowed,hs,rx,tx,_ka=f
+        if tun in peers: continue  # one peer per tunnel; keep the first
+        peers[tun]={'peer':pub,'endpoint':'' if endpoint=='(none)' else endpoint,
+                    'allowed_ips':'' if allowed=='(none)' else allowed.replace(',',', '),
+                    'last_handshake':int(hs),'rx_bytes':int(rx),'tx_bytes':int(tx)}
+    return peers
+
+def _wg_namespace(ns):
+    """Cached {tunnel: peer info} for every WG interface in ns"""
+    now=time.time()
+    with _wg_cache_lock:
+        hit=_wg_cache.get(ns)
+    if hit and now-hit[0]<WG_CACHE_TTL:
+        return hit[1]
+    peers=_wg_dump(ns)
+    with _wg_cache_lock:
+        _wg_cache[ns]=(time.time(),peers)
+    return peers
+
+def _tunnel_info(ns, tunnel, peers):
+    # Namespace dump failed, or the tunnel is not in it (interface gone):
+    # report it DOWN as `wg show <tun>` failing did, not as NO_HANDSHAKE
+    if peers is None or tunnel not in peers:
+        return None
+    r={'tunnel':tunnel,'namespace':ns,'controller':TUNNEL_CONTROLLER.get(tunnel,'?'),'peer':'','endpoint':'','last_handshake':0,'last_handshake_sec':-1,'last_handshake_display':'never','tx_bytes':0,'rx_bytes':0,'allowed_ips':''}
+    p=peers[tunnel]
+    r.update(p)
+    if p['last_handshake']:
+        age=max(0,int(time.time())-p['last_handshake'])
+        r['last_handshake_sec']=age
+        r['last_handshake_display']=_format_age(age)
+    r['transfer_display']=f"{_format_bytes(p['rx_bytes'])} received, {_format_bytes(p['tx_bytes'])} sent"
     return r
 
-def get_all_wg_diagnostics():
+# --- Parallel fan-out ---
+# Per-namespace collectors run on one shared bounded pool; a request waits
+# at most DIAG_DEADLINE seconds and reports stragglers as timed_out instead
+# of blocking on a wedged namespace.
+DIAG_WORKERS = 8
+DIAG_DEADLINE = 2.5
+_diag_pool = ThreadPoolExecutor(max_workers=DIAG_WORKERS, thread_name_prefix='diag')
+# Stale-while-revalidate refreshes fan out onto _diag_pool themselves, so they
+# get their own thread: the bounded pool only ever runs leaf collectors
+_revalidate_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='diag-revalidate')
+
+def _fan_out(jobs, deadline=None):
+    """jobs: {key: (fn, *args)} -> ({key: result}, set of timed-out keys).
+
+    A job that raised is returned as None.
+    """
+    deadline=DIAG_DEADLINE if deadline is None else deadline
+    futs={_diag_pool.submit(job[0],*job[1:]):key for key,job in jobs.items()}
+    done,_=wait(futs,timeout=deadline)
+    results,timed_out={},set()
+    for f,key in futs.items():
+        if f in done:
+            try: results[key]=f.result()
+            except Exception: results[key]=None
+        else:
+            f.cancel()  # no-op once running; the subprocess timeout ends it
+            timed_out.add(key)
+    return results,timed_out
+
+def get_all_wg_diagnostics(deadline=None):
     tunnels=[]
+    peers_by_ns,timed_out=_fan_out({ns:(_wg_namespace,ns) for ns in WG_TUNNEL_MAP},deadline)
     for ns,tun_list in WG_TUNNEL_MAP.items():
+        peers=peers_by_ns.get(ns)
         for tname,peer_ip in tun_list:
-            info=_parse_wg_show(ns,tname)
-            if info is None:
+            info=_tunnel_info(ns,tname,peers)
+            if ns in timed_out:
+                info={'tunnel':tname,'namespace':ns,'controller':TUNNEL_CONTROLLER.get(tname,'?'),'status':'TIMEOUT','error':'wg show timed out','rx_bytes':0,'tx_bytes':0}
+            elif info is None:
                 info={'tunnel':tname,'namespace':ns,'controller':TUNNEL_CONTROLLER.get(tname,'?'),'status':'DOWN','error':'wg show failed','rx_bytes':0,'tx_bytes':0}
             else:
                 hs=info.get('last_handshake_sec',-1)
                 info['status']='NO_HANDSHAKE' if hs<0 else ('STALE' if hs>180 else 'UP')
                 info['rx_display']=_format_bytes(info['rx_bytes'])
                 info['tx_display']=_format_bytes(info['tx_bytes'])
+            info['timed_out']=ns in timed_out
             uplink=ns.replace('ns_','')
             info['uplink']=uplink
             info['uplink_label']=UPLINK_LABELS.get(uplink,uplink)
@@ -124,34 +192,156 @@ def get_all_wg_diagnostics():
 def get_active_path():
     result={}
     try:
-        out=subprocess.check_output(['ip','netns','exec','ns_vip','ip','route','show','default'],text=True,timeout=2).strip()
-        result['ns_vip_default']=out
-        m=re.search(r'dev\s+(\S+)',out); dev=m.group(1) if m else 'unknown'
+        default=[r for r in nsexec.routes('ns_vip') if r['dst']=='default']
+        result['ns_vip_default']='\n'.join(nsexec.format_route(r) for r in default)
+        hops=default[0]['nexthops'] if default else []
+        dev=hops[0].get('dev') if hops else None
         dm={'vip_fa':'fa','vip_fb':'fb','vip_sl_a':'sl_a','vip_sl_b':'sl_b','vip_cell_a':'cell_a','vip_cell_b':'cell_b'}
         result['active_from_route']=dm.get(dev,'unknown')
-        result['has_src']='src 104.204.138.50' in out
+        result['has_src']=any(r['prefsrc']=='104.204.138.50' for r in default)
     except:
         result['error']='Failed'
     return result
 
-def get_namespace_health():
+NAMESPACES = list(nsexec.NAMESPACES)
+
+def _namespace_health(ns):
+    info={'exists':False}
+    try:
+        links=nsexec.links(ns)
+        info['exists']=True
+        info['ifaces_up']=sum(1 for l in links.values() if l['operstate']=='UP')
+        try: info['ipv4_forward']=int(nsexec.sysctl(ns,'net.ipv4.ip_forward'))
+        except: info['ipv4_forward']=0
+        try: info['ipv6_forward']=int(nsexec.sysctl(ns,'net.ipv6.conf.all.forwarding'))
+        except: info['ipv6_forward']=0
+    except:
+        pass
+    return info
+
+def get_namespace_health(deadline=None):
+    results,timed_out=_fan_out({ns:(_namespace_health,ns) for ns in NAMESPACES},deadline)
     health={}
-    for ns in ['ns_fa','ns_fb','ns_sl_a','ns_sl_b','ns_cell_a','ns_cell_b','ns_vip']:
-        info={'exists':False}
-        try:
-            subprocess.check_output(['ip','netns','exec',ns,'ip','link','show','lo'],text=True,timeout=2,stderr=subprocess.DEVNULL)
-            info['exists']=True
-            out=subprocess.check_output(['ip','netns','exec',ns,'ip','link','show'],text=True,timeout=2)
-            info['ifaces_up']=out.count('state UP')
-            try: info['ipv4_forward']=int(subprocess.check_output(['ip','netns','exec',ns,'sysctl','-n','net.ipv4.ip_forward'],text=True,timeout=1).strip())
-            except: info['ipv4_forward']=0
-            try: info['ipv6_forward']=int(subprocess.check_output(['ip','netns','exec',ns,'sysctl','-n','net.ipv6.conf.all.forwarding'],text=True,timeout=1).strip())
-            except: info['ipv6_forward']=0
-        except:
-            pass
+    for ns in NAMESPACES:
+        info=results.get(ns) or {'exists':False}
+        info['timed_out']=ns in timed_out
         health[ns]=info
     return health
 
+# --- Diagnostics cache ---
+# Each view is kept warm by a background refresher at its own cadence and
+# served from cache (stale-while-revalidate).  Refreshes are coalesced:
+# however many requests arrive while one is running, they share its result.
+class CachedView:
+    def __init__(self, name, collect, interval, max_stale):
+        self.name=name
+        self.collect=collect
+        self.interval=interval      # background refresh cadence
+        self.max_stale=max_stale    # older than this: refresh before answering
+        self._cond=threading.Condition()
+        self._value=None
+        self._ts=0
+        self._refreshing=False
+        self._revalidating=False    # a background refresh is queued or running
+        self.refreshes=0
+        self.coalesced=0
+        self.errors=0
+
+    @property
+    def age(self):
+        return time.time()-self._ts if self._ts else None
+
+    def refresh(self, deadline=None):
+        """Collect now, or wait for the collection already in flight.
+
+        deadline (seconds) goes to the collector's fan-out and also bounds
+        the wait on someone else's collection; past it the caller gets
+        whatever the cache holds.
+        """
+        with self._cond:
+            if self._refreshing:
+                self.coalesced+=1
+                self._cond.wait_for(lambda: not self._refreshing,deadline)
+                return self._value,self._ts
+            self._refreshing=True
+        try:
+            value=self.collect() if deadline is None else self.collect(deadline)
+            with self._cond:
+                self._value,self._ts=value,time.time()
+                self.refreshes+=1
+        except Exception:
+            with self._cond:
+                self.errors+=1
+        finally:
+            with self._cond:
+                self._refreshing=False
+                self._cond.notify_all()
+        return self._value,self._ts
+
+    def get(self, max_age=None, deadline=None):
+        """(value, collected_at); refreshes synchronously (within deadline) only if too old"""
+        limit=self.max_stale if max_age is None else max_age
+        with self._cond:
+            value,ts=self._value,self._ts
+            revalidate=(ts and self.interval<time.time()-ts<=limit
+                        and not self._refreshing and not self._revalidating)
+            if revalidate:
+                self._revalidating=True
+        if revalidate:
+            # Serve stale, revalidate in the background
+            _revalidate_pool.submit(self._revalidate)
+        if ts and time.time()-ts<=limit:
+            return value,ts
+        return self.refresh(deadline)
+
+    def _revalidate(self):
+        try:
+            self.refresh()
+        finally:
+            with self._cond:
+                self._revalidating=False
+
+    def stats(self):
+        age=self.age
+        return {'interval':self.interval,'age':round(age,3) if age is not None else None,
+                'refreshes':self.refreshes,'coalesced':self.coalesced,'errors':self.errors}
+
+DIAG_VIEWS = {
+    'tunnels':    CachedView('tunnels', get_all_wg_diagnostics, interval=5, max_stale=30),
+    'path':       CachedView('path', get_active_path, interval=2, max_stale=10),
+    'namespaces': CachedView('namespaces', get_namespace_health, interval=10, max_stale=60),
+}
+
+def _bg_refresher():
+    while True:
+        for view in DIAG_VIEWS.values():
+            age=view.age
+            if age is None or age>=view.interval:
+                try: view.refresh()
+                except: pass
+        time.sleep(0.5)
+
+_refresher_thread = threading.Thread(target=_bg_refresher, daemon=True)
+_refresher_thread.start()
+
+def _cached(name, deadline=None):
+    """Serve a view from cache with its age; ?max_age=<sec> demands fresher data"""
+    max_age=request.args.get('max_age',None,type=float)
+    value,ts=DIAG_VIEWS[name].get(max_age,deadline)
+    return _with_age(value,ts)
+
+def _deadline_arg():
+    """?deadline=<sec> for an on-demand refresh, clamped so a client cannot pin a Flask thread"""
+    d=request.args.get('deadline',None,type=float)
+    return None if d is None else min(max(d,0.1),10.0)
+
+def _with_age(payload, ts):
+    age=max(0.0,time.time()-ts) if ts else 0.0
+    resp=jsonify(payload)
+    resp.headers['Age']=str(int(age))
+    resp.headers['X-Cache-Age']=f"{age:.3f}"
+    return resp
+
 # === Routes ===
 @diag_bp.route('/')
 def diag_index():
@@ -159,23 +349,36 @@ def diag_index():
 
 @diag_bp.route('/api/tunnels')
 def diag_tunnels():
-    return jsonify({'timestamp':time.time(),'tunnels':get_all_wg_diagnostics()})
+    value,ts=DIAG_VIEWS['tunnels'].get(request.args.get('max_age',None,type=float),_deadline_arg())
+    return _with_age({'timestamp':ts,'tunnels':value or []},ts)
 
 @diag_bp.route('/api/path')
 def diag_path():
-    return jsonify(get_active_path())
+    return _cached('path')
 
 @diag_bp.route('/api/namespaces')
 def diag_namespaces():
-    return jsonify(get_namespace_health())
+    return _cached('namespaces',_deadline_arg())
+
+@diag_bp.route('/api/cache')
+def diag_cache():
+    return jsonify({'views':{name:v.stats() for name,v in DIAG_VIEWS.items()},'nsexec':nsexec.stats()})
 
 @diag_bp.route('/api/throughput')
 def diag_throughput():
+    # ?seconds= of history (default 60, what n=30 covered at the old 2 s cadence);
+    # ?n= still picks an exact sample count
+    n = request.args.get('n', type=int)
+    if n is None:
+        n = round(request.args.get('seconds', 60, type=float) / SAMPLE_INTERVAL)
+    n = min(max(n, 1), SAMPLE_HISTORY)
     with _throughput_lock:
-        recent = _throughput_samples[-30:] if _throughput_samples else []
-    return jsonify({'samples': recent})
+        recent = list(_throughput_samples)[-n:]
+    return jsonify({'samples': recent, 'interval': SAMPLE_INTERVAL})
 
 @diag_bp.route('/api/throughput/now')
 def diag_throughput_now():
-    s = _sample_throughput()
-    return jsonify({'timestamp': time.time(), 'tunnels': s})
+    # Latest background sample; sampling here would reset the sampler's baseline
+    with _throughput_lock:
+        latest = _throughput_samples[-1] if _throughput_samples else {'timestamp': 0, 'tunnels': []}
+    return _with_age(latest, latest['timestamp'])
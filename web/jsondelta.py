@@ -0,0 +1,132 @@
+"""PathSteer Guardian - JSON-patch style deltas for the status stream
+
+/api/stream?mode=delta sends a full keyframe every KEYFRAME_INTERVAL
+seconds (on the first tick past it, even when nothing changed, so a client
+that lost a delta on a quiet stream is back in sync within that time) and
+RFC 6902 style operation lists in between:
+
+    id: 1200
+    data: {"type": "key", "seq": 1200, "data": {...full status...}}
+
+    id: 1201
+    data: {"type": "delta", "seq": 1201, "base": 1200,
+           "ops": [{"op": "replace", "path": "/hold_remaining", "value": 3}]}
+
+A client applies a delta only if its base equals the last seq it holds.
+On a gap it resyncs, either by reconnecting (every new stream starts with
+a keyframe) or by fetching /api/stream/keyframe, and then ignores any
+frame whose seq is not newer than the keyframe it applied.
+"""
+import json
+import threading
+import time
+
+KEYFRAME_INTERVAL = 5.0  # seconds
+
+
+def _escape(key):
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def diff(old, new, path=''):
+    """Return the list of add/remove/replace ops that turn old into new.
+
+    Lists of equal length are compared element-wise; a list that changed
+    length is replaced whole (uplink lists are short and rarely resize).
+    """
+    if type(old) is not type(new):
+        return [{'op': 'replace', 'path': path, 'value': new}]
+    if isinstance(new, dict):
+        ops = []
+        for k in old:
+            if k not in new:
+                ops.append({'op': 'remove', 'path': f"{path}/{_escape(k)}"})
+        for k, v in new.items():
+            p = f"{path}/{_escape(k)}"
+            if k not in old:
+                ops.append({'op': 'add', 'path': p, 'value': v})
+            else:
+                ops.extend(diff(old[k], v, p))
+        return ops
+    if isinstance(new, list):
+        if len(old) != len(new):
+            return [{'op': 'replace', 'path': path, 'value': new}]
+        ops = []
+        for i, (a, b) in enumerate(zip(old, new)):
+            ops.extend(diff(a, b, f"{path}/{i}"))
+        return ops
+    if old != new:
+        return [{'op': 'replace', 'path': path, 'value': new}]
+    return []
+
+
+def _frame(seq, payload):
+    return f"id: {seq}\ndata: {json.dumps(payload)}\n\n".encode()
+
+
+class DeltaEncoder:
+    """Stateful snapshot -> SSE frame encoder for the delta stream.
+
+    Called only from the broadcaster's producer thread; keyframe() may be
+    called from any thread to resync a new or lagging subscriber.
+    """
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self._lock = threading.Lock()
+        self._state = (0, None)   # (seq, data) of the last frame sent
+        self._key_at = 0.0        # monotonic time of the last keyframe
+        self._key = None          # cached keyframe bytes for _state
+        self.keyframes = 0
+        self.deltas = 0
+        self.key_bytes = 0
+        self.delta_bytes = 0
+
+    def __call__(self, snap):
+        seq, prev = self._state
+        data = snap.data
+        now = time.monotonic()
+        if prev is not None and now - self._key_at < self.keyframe_interval:
+            ops = diff(prev, data)
+            if not ops:
+                return None
+            with self._lock:
+                self._state = (seq + 1, data)
+                self._key = None
+            frame = _frame(seq + 1, {'type': 'delta', 'seq': seq + 1, 'base': seq, 'ops': ops})
+            self.deltas += 1
+            self.delta_bytes += len(frame)
+            return frame
+        with self._lock:
+            self._state = (seq + 1, data)
+            self._key = None
+        self._key_at = now
+        frame = self.keyframe()
+        self.keyframes += 1
+        self.key_bytes += len(frame)
+        return frame
+
+    def keyframe(self):
+        """Full-state frame for the current seq (None before the first tick)"""
+        with self._lock:
+            seq, data = self._state
+            if data is None:
+                return None
+            if self._key is None:
+                self._key = _frame(seq, {'type': 'key', 'seq': seq, 'data': data})
+            return self._key
+
+    def current(self):
+        """(seq, data) of the last frame sent, for out-of-band resync"""
+        with self._lock:
+            return self._state
+
+    def stats(self):
+        return {
+            'seq': self._state[0],
+            'keyframe_interval_s': self.keyframe_interval,
+            'keyframes': self.keyframes,
+            'deltas': self.deltas,
+            'key_bytes': self.key_bytes,
+            'delta_bytes': self.delta_bytes,
+        }
@@ -0,0 +1,241 @@
+"""PathSteer Guardian - Namespace executor
+
+One long-lived worker thread per network namespace (ns_fa, ns_fb, ns_sl_a,
+ns_sl_b, ns_cell_a, ns_cell_b, ns_vip).  Each worker enters its namespace
+once with setns() and then answers typed queries - link stats and states,
+routes, sysctls - over its own netlink socket and /proc/sys, so callers
+get `ip netns exec ... ip/sysctl/cat` answers without forking.
+
+    links = nsexec.links('ns_vip')
+    routes = nsexec.routes('ns_vip')
+    fwd = nsexec.sysctl('ns_fa', 'net.ipv4.ip_forward')
+    vip = nsexec.LinkCounters('ns_vip', prefix='vip_')     # rates from links()
+
+All calls raise OSError (including TimeoutError) if the namespace is
+missing or the worker does not answer in time.
+"""
+import os
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import Future
+
+from netns import NETNS_DIR, setns
+from rtnl import RT_TABLE_MAIN, dump_links, dump_routes, open_route_socket
+
+NAMESPACES = ('ns_fa', 'ns_fb', 'ns_sl_a', 'ns_sl_b', 'ns_cell_a', 'ns_cell_b', 'ns_vip')
+CALL_TIMEOUT = 2.0
+
+
+class NamespaceWorker:
+    """Thread living inside one namespace, running submitted functions there"""
+
+    def __init__(self, ns):
+        self.ns = ns
+        self.ino = None
+        self.sock = None
+        self.calls = 0
+        self.errors = 0
+        self._seq = 0
+        self._q = queue.Queue()
+        self._thread = None
+
+    def start(self, timeout=CALL_TIMEOUT):
+        path = os.path.join(NETNS_DIR, self.ns)
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        self.ino = os.fstat(fd).st_ino
+        ready = Future()
+        self._thread = threading.Thread(target=self._run, args=(fd, ready), daemon=True,
+                                        name=f"nsexec-{self.ns}")
+        self._thread.start()
+        ready.result(timeout)
+        return self
+
+    def stop(self):
+        self._q.put(None)
+
+    @property
+    def alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self, fd, ready):
+        try:
+            setns(fd)
+            self.sock = open_route_socket()
+        except BaseException as e:
+            ready.set_exception(e)
+            return
+        finally:
+            os.close(fd)
+        ready.set_result(True)
+        while True:
+            item = self._q.get()
+            if item is None:
+                break
+            fn, fut = item
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                fut.set_result(fn(self))
+            except BaseException as e:
+                self.errors += 1
+                fut.set_exception(e)
+        self.sock.close()
+
+    def submit(self, fn):
+        """Run fn(worker) on the namespace thread; returns a Future"""
+        fut = Future()
+        self.calls += 1
+        self._q.put((fn, fut))
+        return fut
+
+    def call(self, fn, timeout=CALL_TIMEOUT):
+        return self.submit(fn).result(timeout)
+
+    def next_seq(self):
+        self._seq += 1
+        return self._seq
+
+    # --- typed queries (run on the worker thread) ---
+    def _links(self):
+        return dump_links(self.sock, self.next_seq())
+
+    def _routes(self, family, table):
+        names = {l['index']: name for name, l in self._links().items()}
+        routes = dump_routes(self.sock, family, table, self.next_seq())
+        for r in routes:
+            for nh in r['nexthops']:
+                nh['dev'] = names.get(nh['oif'])
+        return routes
+
+    def _sysctl(self, name):
+        # /proc/sys/net resolves against the opening thread's namespace
+        with open('/proc/sys/' + name.replace('.', '/')) as f:
+            return f.read().strip()
+
+
+_workers = {}
+_workers_lock = threading.Lock()
+
+
+def worker(ns):
+    """Running worker for ns, restarted if the namespace was recreated"""
+    try:
+        ino = os.stat(os.path.join(NETNS_DIR, ns)).st_ino
+    except OSError:
+        raise OSError(f"namespace {ns} not found")
+    with _workers_lock:
+        w = _workers.get(ns)
+        if w is not None and w.alive and w.ino == ino:
+            return w
+        if w is not None:
+            w.stop()
+        w = _workers[ns] = NamespaceWorker(ns).start()
+        return w
+
+
+def links(ns, timeout=CALL_TIMEOUT):
+    """{ifname: {index, up, operstate, rx_bytes, tx_bytes, ...}}"""
+    return worker(ns).call(NamespaceWorker._links, timeout)
+
+
+def routes(ns, family=socket.AF_INET, table=RT_TABLE_MAIN, timeout=CALL_TIMEOUT):
+    """Routes with nexthop device names resolved (see rtnl.dump_routes)"""
+    return worker(ns).call(lambda w: w._routes(family, table), timeout)
+
+
+def sysctl(ns, name, timeout=CALL_TIMEOUT):
+    """Value of a net.* sysctl inside ns, as a string"""
+    return worker(ns).call(lambda w: w._sysctl(name), timeout)
+
+
+class LinkCounters:
+    """Per-interface rates for one namespace, read through its worker.
+
+    sample() takes a reading and computes rates against the previous one;
+    callers that only want the latest numbers use last_rates so they do not
+    disturb the sampling baseline.
+    """
+
+    def __init__(self, ns, prefix=''):
+        self.ns = ns
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._prev = None
+        self._prev_ts = 0
+        self.last_rates = {}
+        self.sampled_at = 0
+        self.errors = 0
+
+    def read(self):
+        """Raw counters for matching interfaces"""
+        with self._lock:
+            return self._read()
+
+    def _read(self):
+        try:
+            current = links(self.ns)
+        except OSError:
+            # Namespace gone or recreated: counters restart, so does the baseline
+            self.errors += 1
+            self._prev = None
+            raise
+        return {k: v for k, v in current.items() if k.startswith(self.prefix)}
+
+    def sample(self, min_interval=0.05):
+        """Read counters and return {ifname: {rx_bps, tx_bps, rx_pps, tx_pps, ...}}
+
+        Readings closer together than min_interval return the previous
+        rates rather than dividing by a tiny dt.
+        """
+        with self._lock:
+            now = time.time()
+            if self._prev is not None and now - self._prev_ts < min_interval:
+                return self.last_rates
+            curr = self._read()
+            prev, dt = self._prev, now - self._prev_ts
+            rates = {}
+            for name, c in curr.items():
+                r = {'rx_bytes': c.get('rx_bytes', 0), 'tx_bytes': c.get('tx_bytes', 0),
+                     'rx_packets': c.get('rx_packets', 0), 'tx_packets': c.get('tx_packets', 0),
+                     'rx_bps': 0, 'tx_bps': 0, 'rx_pps': 0, 'tx_pps': 0,
+                     'up': c['up'], 'operstate': c['operstate']}
+                p = prev.get(name) if prev else None
+                if p and dt > 0 and p['index'] == c['index']:
+                    for field, key, scale in (('rx_bps', 'rx_bytes', 8), ('tx_bps', 'tx_bytes', 8),
+                                              ('rx_pps', 'rx_packets', 1), ('tx_pps', 'tx_packets', 1)):
+                        delta = c.get(key, 0) - p.get(key, 0)
+                        if delta >= 0:
+                            r[field] = round(delta * scale / dt)
+                rates[name] = r
+            self._prev, self._prev_ts = curr, now
+            self.last_rates, self.sampled_at = rates, now
+            return rates
+
+
+def format_route(route):
+    """Render a route the way `ip route show` does (for display/compat)"""
+    parts = [route['dst']]
+    hops = route['nexthops']
+    if len(hops) == 1:
+        if hops[0]['gateway']:
+            parts += ['via', hops[0]['gateway']]
+        if hops[0].get('dev'):
+            parts += ['dev', hops[0]['dev']]
+    if route['prefsrc']:
+        parts += ['src', route['prefsrc']]
+    if route['metric']:
+        parts += ['metric', str(route['metric'])]
+    text = ' '.join(parts)
+    if len(hops) > 1:
+        for nh in hops:
+            via = f"via {nh['gateway']} " if nh['gateway'] else ''
+            text += f"\n\tnexthop {via}dev {nh.get('dev')} weight {nh['weight']}"
+    return text
+
+
+def stats():
+    with _workers_lock:
+        return {ns: {'alive': w.alive, 'calls': w.calls, 'errors': w.errors}
+                for ns, w in _workers.items()}
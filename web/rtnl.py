@@ -0,0 +1,165 @@
+"""PathSteer Guardian - Minimal rtnetlink reader for namespace link counters
+
+Reads per-interface counters (IFLA_STATS64) with one RTM_GETLINK dump over
+a netlink socket opened inside the target namespace, instead of forking
+`ip netns exec <ns> cat /proc/net/dev`.  A netlink socket stays bound to
+the namespace it was created in, so the namespace is entered once and the
+socket is reused for every read (nsexec keeps one per namespace worker).
+"""
+import os
+import socket
+import struct
+
+# setns/in_netns live in scripts/netns.py, shared with the capture daemons
+from netns import in_netns
+
+NETLINK_ROUTE = 0
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+RTM_NEWROUTE = 24
+RTM_GETROUTE = 26
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RTA_PREFSRC = 7
+RTA_MULTIPATH = 9
+RTA_TABLE = 15
+RT_TABLE_MAIN = 254
+IFLA_IFNAME = 3
+IFLA_OPERSTATE = 16
+IFLA_STATS64 = 23
+IFF_UP = 0x1
+
+_NLMSGHDR = struct.Struct('=IHHII')
+_IFINFOMSG = struct.Struct('=BxHiII')
+_RTATTR = struct.Struct('=HH')
+_STATS64 = struct.Struct('=8Q')
+_RTMSG = struct.Struct('=BBBBBBBBI')
+_RTNEXTHOP = struct.Struct('=HBBi')
+_STATS64_FIELDS = ('rx_packets', 'tx_packets', 'rx_bytes', 'tx_bytes',
+                   'rx_errors', 'tx_errors', 'rx_dropped', 'tx_dropped')
+OPERSTATES = ('UNKNOWN', 'NOTPRESENT', 'DOWN', 'LOWERLAYERDOWN',
+              'TESTING', 'DORMANT', 'UP')
+
+def open_route_socket(ns=None):
+    """NETLINK_ROUTE socket in namespace ns (None = our own namespace)"""
+    def make():
+        s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_CLOEXEC, NETLINK_ROUTE)
+        s.bind((0, 0))
+        return s
+    return make() if ns is None else in_netns(ns, make)
+
+
+def _attrs(buf, off, end):
+    while off + _RTATTR.size <= end:
+        length, kind = _RTATTR.unpack_from(buf, off)
+        if length < _RTATTR.size:
+            break
+        yield kind, buf[off + _RTATTR.size:off + length]
+        off += (length + 3) & ~3
+
+
+def nl_dump(sock, msg_type, body, seq):
+    """Send one dump request and yield (type, payload) for each reply message"""
+    req = _NLMSGHDR.pack(_NLMSGHDR.size + len(body), msg_type,
+                         NLM_F_REQUEST | NLM_F_DUMP, seq, 0) + body
+    sock.send(req)
+    while True:
+        buf = sock.recv(65536)
+        off = 0
+        while off + _NLMSGHDR.size <= len(buf):
+            length, kind, _, mseq, _ = _NLMSGHDR.unpack_from(buf, off)
+            if length < _NLMSGHDR.size:
+                return
+            payload = buf[off + _NLMSGHDR.size:off + length]
+            off += (length + 3) & ~3
+            if mseq != seq:
+                continue
+            if kind == NLMSG_DONE:
+                return
+            if kind == NLMSG_ERROR:
+                err = -struct.unpack_from('=i', payload)[0]
+                if err:
+                    raise OSError(err, os.strerror(err))
+                return
+            yield kind, payload
+
+
+def dump_links(sock, seq=1):
+    """{ifname: {index, up, operstate, rx_bytes, tx_bytes, rx_packets, ...}}"""
+    links = {}
+    body = _IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+    for kind, payload in nl_dump(sock, RTM_GETLINK, body, seq):
+        if kind != RTM_NEWLINK:
+            continue
+        _, _, index, flags, _ = _IFINFOMSG.unpack_from(payload)
+        link = {'index': index, 'up': bool(flags & IFF_UP), 'operstate': 'UNKNOWN'}
+        name = None
+        for akind, data in _attrs(payload, _IFINFOMSG.size, len(payload)):
+            if akind == IFLA_IFNAME:
+                name = data.split(b'\0', 1)[0].decode()
+            elif akind == IFLA_OPERSTATE:
+                state = data[0]
+                link['operstate'] = OPERSTATES[state] if state < len(OPERSTATES) else 'UNKNOWN'
+            elif akind == IFLA_STATS64 and len(data) >= _STATS64.size:
+                link.update(zip(_STATS64_FIELDS, _STATS64.unpack_from(data)))
+        if name:
+            links[name] = link
+    return links
+
+
+def _addr(family, data):
+    return socket.inet_ntop(family, data)
+
+
+def dump_routes(sock, family=socket.AF_INET, table=RT_TABLE_MAIN, seq=1):
+    """Routes in table as [{dst, table, protocol, metric, prefsrc, nexthops: [{oif, gateway, weight}]}].
+
+    dst is 'default' or 'a.b.c.d/len'; oif is an ifindex (resolve with
+    dump_links).  ECMP routes carry one entry per nexthop.
+    """
+    routes = []
+    body = _RTMSG.pack(family, 0, 0, 0, 0, 0, 0, 0, 0)
+    for kind, payload in nl_dump(sock, RTM_GETROUTE, body, seq):
+        if kind != RTM_NEWROUTE:
+            continue
+        fam, dst_len, _, _, tbl, proto, _, _, _ = _RTMSG.unpack_from(payload)
+        route = {'dst': 'default', 'table': tbl, 'protocol': proto, 'metric': 0,
+                 'prefsrc': None, 'nexthops': []}
+        hop = {'oif': None, 'gateway': None, 'weight': 1}
+        for akind, data in _attrs(payload, _RTMSG.size, len(payload)):
+            if akind == RTA_DST:
+                route['dst'] = f"{_addr(fam, data)}/{dst_len}"
+            elif akind == RTA_TABLE:
+                route['table'] = struct.unpack_from('=I', data)[0]
+            elif akind == RTA_PRIORITY:
+                route['metric'] = struct.unpack_from('=I', data)[0]
+            elif akind == RTA_PREFSRC:
+                route['prefsrc'] = _addr(fam, data)
+            elif akind == RTA_OIF:
+                hop['oif'] = struct.unpack_from('=i', data)[0]
+            elif akind == RTA_GATEWAY:
+                hop['gateway'] = _addr(fam, data)
+            elif akind == RTA_MULTIPATH:
+                off = 0
+                while off + _RTNEXTHOP.size <= len(data):
+                    length, _, hops, ifindex = _RTNEXTHOP.unpack_from(data, off)
+                    if length < _RTNEXTHOP.size:
+                        break
+                    nh = {'oif': ifindex, 'gateway': None, 'weight': hops + 1}
+                    for nkind, ndata in _attrs(data, off + _RTNEXTHOP.size, off + length):
+                        if nkind == RTA_GATEWAY:
+                            nh['gateway'] = _addr(fam, ndata)
+                    route['nexthops'].append(nh)
+                    off += (length + 3) & ~3
+        if route['table'] != table:
+            continue
+        if not route['nexthops'] and (hop['oif'] is not None or hop['gateway']):
+            route['nexthops'].append(hop)
+        routes.append(route)
+    return routes
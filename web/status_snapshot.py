@@ -0,0 +1,146 @@
+"""PathSteer Guardian - Shared status snapshot cache
+
+One merged status document is built per tick and shared by every caller
+(/api/status, /api/stream, /api/log/status).  Source files under
+/run/pathsteer are only re-parsed when their (inode, mtime, size) changes.
+"""
+import json
+import os
+import threading
+import time
+
+
+class JsonFileCache:
+    """Parsed-JSON cache for a single file keyed on inode/mtime/size"""
+
+    def __init__(self, path):
+        self.path = path
+        self._key = None
+        self._data = None
+        self._body = None
+        self.parses = 0
+        self.reuses = 0
+
+    def load(self):
+        """Return (data, body) for the current file, or (None, None) if unreadable.
+
+        body is the raw file text, so callers that just forward the file can
+        skip re-encoding it.
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self._key = self._data = self._body = None
+            return None, None
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if key == self._key:
+            self.reuses += 1
+            return self._data, self._body
+        try:
+            with open(self.path) as f:
+                body = f.read()
+            data = json.loads(body)
+        except (OSError, ValueError):
+            # Half-written file (daemon writes status.json in place); keep
+            # the last good parse and retry on the next tick
+            return self._data, self._body
+        self._key, self._data, self._body = key, data, body
+        self.parses += 1
+        return data, body
+
+    def stats(self):
+        return {'path': self.path, 'parses': self.parses, 'reuses': self.reuses}
+
+
+class Snapshot:
+    """Immutable view of one status tick.  Treat data as read-only."""
+    __slots__ = ('seq', 'built', 'data', 'body', 'raw_body')
+
+    def __init__(self, seq, built, data, body, raw_body):
+        self.seq = seq
+        self.built = built
+        self.data = data          # merged status dict
+        self.body = body          # json.dumps(data), encoded once
+        self.raw_body = raw_body  # daemon status.json text as written
+
+    @property
+    def age(self):
+        return time.time() - self.built
+
+
+class StatusSnapshot:
+    """Rebuilds the merged status at most once per tick.
+
+    build is called as build() -> (data, raw_body) under the refresh lock,
+    so concurrent callers arriving during a rebuild wait for and share the
+    same result instead of each rebuilding.
+    """
+
+    def __init__(self, build, tick=0.1):
+        self._build = build
+        self.tick = tick
+        self._lock = threading.Lock()
+        # Guards _snap/_gen only, so invalidate() never waits out a rebuild
+        self._gen_lock = threading.Lock()
+        self._gen = 0
+        self._snap = None
+        self._seq = 0
+        self.hits = 0
+        self.misses = 0
+        self.build_errors = 0
+        self.last_build_ms = 0.0
+
+    def get(self, max_age=None):
+        """Return the current Snapshot, rebuilding if older than max_age (default: tick)"""
+        if max_age is None:
+            max_age = self.tick
+        snap = self._snap
+        if snap is not None and time.time() - snap.built < max_age:
+            self.hits += 1
+            return snap
+        with self._lock:
+            snap = self._snap
+            if snap is not None and time.time() - snap.built < max_age:
+                self.hits += 1
+                return snap
+            self.misses += 1
+            return self._refresh()
+
+    def invalidate(self):
+        """Force the next get() to rebuild (e.g. after a command was sent)"""
+        with self._gen_lock:
+            self._gen += 1
+            self._snap = None
+
+    def _refresh(self):
+        t0 = time.time()
+        with self._gen_lock:
+            gen = self._gen
+        try:
+            data, raw_body = self._build()
+        except Exception:
+            self.build_errors += 1
+            if self._snap is not None:
+                return self._snap
+            raise
+        self._seq += 1
+        snap = Snapshot(self._seq, time.time(), data, json.dumps(data), raw_body)
+        with self._gen_lock:
+            # Invalidated mid-build: this caller gets the result, but it is not
+            # published, so the next get() rebuilds from the new state
+            if self._gen == gen:
+                self._snap = snap
+        self.last_build_ms = round((time.time() - t0) * 1000, 3)
+        return snap
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+            'build_errors': self.build_errors,
+            'last_build_ms': self.last_build_ms,
+            'seq': self._seq,
+            'tick': self.tick,
+        }